@@ -0,0 +1,93 @@
+"""
+Benchmark model inference latency under the configured execution profile
+
+Usage:
+    python benchmark.py --iterations 20
+    python benchmark.py --no-inference-mode --no-channels-last --no-warmup   # eager fp32 baseline
+    python benchmark.py --bf16 --compile
+"""
+
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+from PIL import Image
+
+from config.settings import Settings
+from models.model_loader import ModelLoader
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark crop disease model inference")
+    parser.add_argument("--iterations", type=int, default=20, help="Timed iterations per stage")
+    parser.add_argument("--batch-size", type=int, default=8, help="Batch size for the batched classifier stage")
+    parser.add_argument("--skip-caption", action="store_true", help="Do not benchmark BLIP captioning")
+    parser.add_argument("--inference-mode", dest="inference_mode", action="store_true", default=None)
+    parser.add_argument("--no-inference-mode", dest="inference_mode", action="store_false")
+    parser.add_argument("--bf16", dest="bf16_autocast", action="store_true", default=None)
+    parser.add_argument("--no-bf16", dest="bf16_autocast", action="store_false")
+    parser.add_argument("--channels-last", dest="channels_last", action="store_true", default=None)
+    parser.add_argument("--no-channels-last", dest="channels_last", action="store_false")
+    parser.add_argument("--compile", dest="compile_models", action="store_true", default=None)
+    parser.add_argument("--no-compile", dest="compile_models", action="store_false")
+    parser.add_argument("--warmup", dest="warmup_enabled", action="store_true", default=None)
+    parser.add_argument("--no-warmup", dest="warmup_enabled", action="store_false")
+    return parser.parse_args()
+
+
+def time_stage(fn, iterations: int) -> dict:
+    """Time fn() and return latency statistics in milliseconds"""
+    first_start = time.perf_counter()
+    fn()
+    first_ms = (time.perf_counter() - first_start) * 1000
+
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+
+    samples.sort()
+    return {
+        "first_call_ms": round(first_ms, 2),
+        "p50_ms": round(statistics.median(samples), 2),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 2),
+        "mean_ms": round(statistics.fmean(samples), 2),
+    }
+
+
+def main():
+    args = parse_args()
+
+    # Command line flags override Settings / environment values
+    overrides = {
+        key: value for key, value in vars(args).items()
+        if key in ("inference_mode", "bf16_autocast", "channels_last", "compile_models", "warmup_enabled")
+        and value is not None
+    }
+    settings = Settings(**overrides)
+
+    loader = ModelLoader(settings)
+    load_start = time.perf_counter()
+    asyncio.run(loader.load_models())
+    load_seconds = time.perf_counter() - load_start
+
+    image = Image.new("RGB", (640, 480), color=(90, 140, 60))
+    batch = loader.transform(image).unsqueeze(0).repeat(args.batch_size, 1, 1, 1).to(loader.device)
+
+    results = {
+        "execution_profile": loader.get_execution_profile(),
+        "load_seconds": round(load_seconds, 2),
+        "classify_single": time_stage(lambda: loader.classify_tensor(batch[:1]), args.iterations),
+        f"classify_batch_{args.batch_size}": time_stage(lambda: loader.classify_tensor(batch), args.iterations),
+    }
+    if not args.skip_caption and loader.blip_model is not None:
+        results["blip_caption"] = time_stage(lambda: loader.generate_blip_caption(image), max(1, args.iterations // 4))
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+"""
+Offline bulk diagnosis over a directory of field images
+
+Walks a directory, decodes images in parallel worker processes, classifies them
+(and optionally captions them) in large batches and appends results to CSV or
+Parquet as it goes. Re-running with the same output resumes where it stopped.
+
+Usage:
+    python bulk_diagnose.py /data/field_images --output results.csv
+    python bulk_diagnose.py /data/field_images --output results_parquet --format parquet --caption
+"""
+
+import argparse
+import asyncio
+import csv
+import os
+import time
+
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+
+from config.settings import get_settings
+from models.model_loader import ModelLoader
+from services.prediction_service import PredictionService
+
+RESULT_COLUMNS = ["path", "crop", "disease", "confidence", "caption", "error"]
+
+# BLIP resizes to 384px anyway; shrinking first keeps worker-to-main transfers small
+CAPTION_IMAGE_SIZE = 384
+
+
+class ImageFileDataset(Dataset):
+    """Decodes and preprocesses images inside DataLoader worker processes"""
+
+    def __init__(self, paths, transform, keep_images: bool):
+        self.paths = paths
+        self.transform = transform
+        self.keep_images = keep_images
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        path = self.paths[index]
+        try:
+            with Image.open(path) as img:
+                image = img.convert("RGB")
+            tensor = self.transform(image)
+            if self.keep_images:
+                image.thumbnail((CAPTION_IMAGE_SIZE, CAPTION_IMAGE_SIZE))
+                return path, tensor, image, None
+            return path, tensor, None, None
+        except Exception as e:
+            return path, None, None, f"{type(e).__name__}: {e}"
+
+
+def collate_images(items):
+    """Stack decodable images into one tensor and keep decode errors aside"""
+    ok = [item for item in items if item[1] is not None]
+    failed = [(path, error) for path, tensor, _, error in items if tensor is None]
+    paths = [item[0] for item in ok]
+    batch = torch.stack([item[1] for item in ok]) if ok else None
+    images = [item[2] for item in ok] if ok and ok[0][2] is not None else None
+    return paths, batch, images, failed
+
+
+class CsvResultWriter:
+    """Appends result rows to a CSV file; the file itself is the resume checkpoint"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._repair_partial_line()
+        is_new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        self._file = open(self.path, "a", newline="", encoding="utf-8")
+        self._writer = csv.DictWriter(self._file, fieldnames=RESULT_COLUMNS)
+        if is_new:
+            self._writer.writeheader()
+
+    def load_done(self) -> set:
+        if not os.path.exists(self.path):
+            return set()
+        with open(self.path, "r", newline="", encoding="utf-8") as f:
+            return {row["path"] for row in csv.DictReader(f) if row.get("path")}
+
+    def write(self, rows):
+        self._writer.writerows(rows)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+    def _repair_partial_line(self):
+        """Drop a trailing row cut off by an interrupted run"""
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            if not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+
+
+class ParquetResultWriter:
+    """Writes each batch as a new part file in a directory; existing parts are the checkpoint"""
+
+    def __init__(self, path: str):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("❌ Parquet output requires pyarrow: pip install pyarrow")
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+        self._next_part = len(self._parts())
+
+    def load_done(self) -> set:
+        done = set()
+        for part in self._parts():
+            done.update(self.pq.read_table(part, columns=["path"]).column("path").to_pylist())
+        return done
+
+    def write(self, rows):
+        table = self.pa.Table.from_pylist(rows, schema=self.pa.schema([
+            ("path", self.pa.string()),
+            ("crop", self.pa.string()),
+            ("disease", self.pa.string()),
+            ("confidence", self.pa.float64()),
+            ("caption", self.pa.string()),
+            ("error", self.pa.string()),
+        ]))
+        # Write to a temp name and rename so a crash never leaves a half-written part
+        final_path = os.path.join(self.path, f"part-{self._next_part:06d}.parquet")
+        self.pq.write_table(table, final_path + ".tmp")
+        os.replace(final_path + ".tmp", final_path)
+        self._next_part += 1
+
+    def close(self):
+        pass
+
+    def _parts(self):
+        return sorted(
+            os.path.join(self.path, name) for name in os.listdir(self.path) if name.endswith(".parquet")
+        )
+
+
+def find_images(root: str, extensions) -> list:
+    """Recursively list image files under root in a stable order"""
+    extensions = {ext.lower() for ext in extensions}
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if os.path.splitext(name)[1].lower() in extensions:
+                paths.append(os.path.join(dirpath, name))
+    return paths
+
+
+def parse_args():
+    cpu_count = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description="Bulk crop disease diagnosis over an image directory")
+    parser.add_argument("input_dir", help="Directory to scan (recursively) for images")
+    parser.add_argument("--output", required=True, help="CSV file, or directory of Parquet parts")
+    parser.add_argument("--format", choices=["csv", "parquet"], default=None,
+                        help="Output format (default: from the --output extension)")
+    parser.add_argument("--caption", action="store_true", help="Also generate BLIP captions (much slower)")
+    parser.add_argument("--batch-size", type=int, default=64, help="Images per forward pass")
+    parser.add_argument("--workers", type=int, default=max(1, cpu_count // 2),
+                        help="Decoding worker processes")
+    parser.add_argument("--threads", type=int, default=cpu_count, help="Torch intra-op threads for inference")
+    parser.add_argument("--report-every", type=float, default=10.0, help="Seconds between progress reports")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    output_format = args.format or ("csv" if args.output.lower().endswith(".csv") else "parquet")
+    torch.set_num_threads(args.threads)
+
+    settings = get_settings()
+    extensions = set(settings.allowed_image_extensions) | {".tif"}
+    paths = find_images(args.input_dir, extensions)
+
+    writer = CsvResultWriter(args.output) if output_format == "csv" else ParquetResultWriter(args.output)
+    done = writer.load_done()
+    pending = [path for path in paths if path not in done]
+    print(f"📁 Found {len(paths)} images, {len(done)} already processed, {len(pending)} to go")
+    if not pending:
+        writer.close()
+        return
+
+    # Warmup is pointless here; the first batch is amortized over the whole run
+    settings = settings.model_copy(update={"warmup_enabled": False})
+    model_loader = ModelLoader(settings)
+    asyncio.run(model_loader.load_models(captioning=args.caption))
+    prediction_service = PredictionService(model_loader)
+
+    loader = DataLoader(
+        ImageFileDataset(pending, model_loader.transform, keep_images=args.caption),
+        batch_size=args.batch_size,
+        num_workers=args.workers,
+        collate_fn=collate_images,
+        prefetch_factor=4 if args.workers > 0 else None,
+        persistent_workers=args.workers > 0,
+    )
+
+    processed = 0
+    start = time.perf_counter()
+    last_report = start
+    try:
+        for batch_paths, batch, images, failed in loader:
+            rows = [
+                {"path": path, "crop": None, "disease": None, "confidence": None, "caption": None, "error": error}
+                for path, error in failed
+            ]
+            if batch is not None:
+                results = prediction_service.analyze_batch(batch, images)
+                rows.extend({"path": path, **result, "error": None} for path, result in zip(batch_paths, results))
+
+            writer.write(rows)
+            processed += len(rows)
+
+            now = time.perf_counter()
+            if now - last_report >= args.report_every:
+                rate = processed / (now - start)
+                eta = (len(pending) - processed) / rate if rate else 0
+                print(f"📊 {processed}/{len(pending)} images, {rate:.1f} img/s, ETA {eta / 60:.1f} min")
+                last_report = now
+
+    except KeyboardInterrupt:
+        print("⏸️ Interrupted; re-run the same command to resume")
+    finally:
+        writer.close()
+
+    elapsed = time.perf_counter() - start
+    rate = processed / elapsed if elapsed else 0.0
+    print(f"✅ Processed {processed} images in {elapsed:.1f}s ({rate:.1f} img/s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -13,14 +13,78 @@ class Settings(BaseSettings):
     
     # Model Paths
     swin_model_path: str = os.path.join(os.path.dirname(__file__), "..", "swinv2_tiny_crop_disease")
+    model_versions_dir: str = os.path.join(os.path.dirname(__file__), "..", "model_versions")  # One subdirectory per classifier version
+    model_version: str = ""  # Version to load at startup; empty picks the newest (or swin_model_path if none)
+    model_watch_interval: float = 5.0  # Seconds between checks of model_versions_dir/ACTIVE; 0 disables
     
     # API Configuration
     max_file_size: int = 10 * 1024 * 1024  # 10MB
     allowed_image_extensions: list = [".jpg", ".jpeg", ".png", ".bmp", ".tiff"]
+    max_image_pixels: int = 40_000_000  # Reject decompression bombs before decoding
+    upload_chunk_size: int = 64 * 1024  # Bytes read per chunk while streaming uploads
+    
+    # Admission Control (per pool: concurrent requests, waiting requests, max seconds waiting)
+    image_concurrency: int = 2
+    image_queue_size: int = 32
+    image_queue_deadline: float = 20.0
+    llm_concurrency: int = 16
+    llm_queue_size: int = 128
+    llm_queue_deadline: float = 10.0
+    
+    # Tiled Analysis Configuration
+    tile_size: int = 512  # Tile side in source pixels; grows for very large images
+    tile_overlap: float = 0.25
+    max_tiles: int = 36  # Upper bound on tiles per image (bounds latency)
+    tile_batch_size: int = 48  # Tiles per forward pass (the whole-image view rides along)
+    tile_disease_threshold: float = 0.6  # Tile probability (given the crop) needed for a local lesion to set the diagnosis
+    tile_min_crop_mass: float = 0.5  # Tiles with less probability on the diagnosed crop can't override it and show 0 in the heatmap
+    
+    # Video Diagnosis Configuration
+    max_video_size: int = 200 * 1024 * 1024  # 200MB
+    video_sample_fps: float = 2.0  # Frames sampled per second of video (lowered for long videos)
+    video_max_frames: int = 120  # Upper bound on frames classified per video
+    video_hash_threshold: int = 6  # Max dHash bit difference (of 64) for a frame to count as a duplicate
+    video_batch_size: int = 16  # Frames per forward pass
+    video_caption_frames: int = 3  # Representative frames captioned per video
+    
+    # Job Queue Configuration
+    job_db_path: str = os.path.join(os.path.dirname(__file__), "..", "data", "jobs.sqlite3")
+    job_workers: int = 2
+    job_ttl_seconds: int = 15 * 60  # Queued jobs older than this are expired
+    job_result_ttl_seconds: int = 24 * 60 * 60  # Finished jobs are kept this long for polling
+    job_poll_interval: float = 1.0
+    job_lease_seconds: int = 60  # Running jobs whose worker stops renewing the lease this long are requeued
+    job_webhook_timeout: float = 10.0
+    job_webhook_allowed_hosts: list = []  # If set, callback_url hosts must be listed here; otherwise any public host
+    
+    # Similar Cases Configuration
+    similarity_enabled: bool = True
+    similarity_index_dir: str = os.path.join(os.path.dirname(__file__), "..", "data", "similarity")
+    similarity_ann_threshold: int = 50_000  # Switch from exact to IVF search past this many vectors
+    similarity_nprobe: int = 16  # IVF lists scanned per query
+    
+    # Session Configuration
+    session_ttl_seconds: int = 60 * 60  # Idle sessions are dropped after this
+    session_max_sessions: int = 10_000
+    session_max_turns: int = 8  # Q&A turns kept in the prompt before compaction
+    session_max_turn_chars: int = 600
+    
+    # Profiling Configuration
+    admin_token: str = ""  # Required to request per-request profiling; empty disables it
+    profile_trace_dir: str = os.path.join(os.path.dirname(__file__), "..", "data", "traces")
     
     # Device Configuration  
     device: str = "cuda" if torch.cuda.is_available() else "cpu"
     
+    # Execution Profile
+    inference_mode: bool = True  # torch.inference_mode instead of no_grad
+    bf16_autocast: bool = False  # Only takes effect on hardware with native bf16
+    channels_last: bool = True
+    compile_models: bool = False  # torch.compile the classifier and BLIP vision encoder
+    warmup_enabled: bool = True
+    warmup_batch_size: int = 4
+    warmup_iterations: int = 2
+    
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         if not self.openai_api_key:
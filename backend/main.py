@@ -4,22 +4,31 @@ Provides image analysis with caption, crop identification, and disease detection
 """
 
 import os
+import asyncio
 import json
-import tempfile
-from typing import Optional
+import hmac
+from typing import Optional, List
 from pathlib import Path
 
 import torch
 from PIL import Image
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+from fastapi import FastAPI, File, UploadFile, Form, Header, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import uvicorn
 
 # Import model utilities
-from models.model_loader import ModelLoader
+from models.model_loader import ModelLoader, ModelSwapInProgressError
 from services.prediction_service import PredictionService
 from services.openai_service import OpenAIService
+from services.upload_service import UploadService, UploadRejectedError, UploadLimitMiddleware, BytesUpload
+from services.single_flight import SingleFlight, normalize_text
+from services.job_queue import JobQueue, PRIORITY_LANES
+from services.request_profiler import RequestProfilerMiddleware, stage
+from services.similarity_index import SimilarityIndexes
+from services.session_service import DiagnosisSession, SessionStore, SUPPORTED_LANGUAGES
+from services.video_service import VideoService
+from services.admission_control import AdmissionController, AdmissionMiddleware, AdmissionRejectedError
 from config.settings import get_settings
 
 # Initialize FastAPI app
@@ -29,6 +38,46 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# Middleware added last runs first: CORS wraps profiling, which wraps upload limits and admission control
+
+# Admission control: image inference and LLM-backed endpoints get separate
+# concurrency limits so a burst of uploads can't slow down cheap text requests.
+# Text endpoints are admitted here; image endpoints take an image slot only
+# around inference (see analyze_upload), not while the upload streams in.
+admission_controller = AdmissionController(get_settings())
+app.add_middleware(
+    AdmissionMiddleware,
+    controller=admission_controller,
+    routes={
+        "/ask/": ("llm", "normal"),
+        "/translate/": ("llm", "normal"),
+        "/translate-result/": ("llm", "normal"),
+    },
+)
+
+# Upload size and format limits are enforced while the body streams in,
+# before Starlette spools the multipart form to disk
+upload_service = UploadService(get_settings())
+app.add_middleware(
+    UploadLimitMiddleware,
+    upload_service=upload_service,
+    routes={
+        "/upload-image/": "image",
+        "/diagnose/": "image",
+        "/diagnose/tiled": "image",
+        "/similar/": "image",
+        "/jobs/diagnose": "image",
+        "/diagnose/video": "video",
+    },
+)
+
+# Opt-in per-request profiling (X-Profile: 1 plus X-Admin-Token)
+app.add_middleware(
+    RequestProfilerMiddleware,
+    admin_token=get_settings().admin_token,
+    trace_dir=get_settings().profile_trace_dir,
+)
+
 # Configure CORS - Production ready
 allowed_origins = [
     "http://localhost:5173", 
@@ -48,22 +97,96 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Profile-Trace-Id", "Retry-After"],
 )
 
 # Global services
 model_loader = None
 prediction_service = None
 openai_service = None
+single_flight = None
+job_queue = None
+similarity_indexes = None
+model_watch_task = None
+session_store = None
+video_service = None
 
 # Response models
 class AnalysisResponse(BaseModel):
     caption: str
     crop: str
     disease: str
+    session_id: Optional[str] = None
+    model_version: Optional[str] = None
+
+class TileGrid(BaseModel):
+    rows: int
+    cols: int
+    count: int
+    size: List[int]
+
+class TiledAnalysisResponse(AnalysisResponse):
+    confidence: float
+    heatmap: List[List[float]]
+    tiles: TileGrid
+
+class VideoSegment(BaseModel):
+    start: float
+    end: float
+    crop: str
+    disease: str
+    confidence: float
+    frames: int
+    caption: Optional[str] = None
+
+class VideoStats(BaseModel):
+    duration: Optional[float] = None
+    decoded_frames: int
+    sampled_frames: int
+    duplicates_dropped: int
+    analyzed_frames: int
+    truncated: bool
+    elapsed_seconds: float
+    decode_fps: float
+    analyzed_fps: float
+
+class VideoAnalysisResponse(BaseModel):
+    crop: str
+    disease: str
+    segments: List[VideoSegment]
+    stats: VideoStats
+    model_version: Optional[str] = None
 
 class QuestionResponse(BaseModel):
     answer: str
 
+class SimilarCase(BaseModel):
+    case_id: int
+    score: float
+    crop: str
+    disease: str
+    caption: Optional[str] = None
+    model_version: Optional[str] = None
+    created_at: float
+
+class SimilarCasesResponse(BaseModel):
+    cases: List[SimilarCase]
+
+class ModelSwapRequest(BaseModel):
+    version: Optional[str] = None  # Defaults to the newest version directory
+
+class JobResponse(BaseModel):
+    job_id: str
+    status: str
+    priority: str
+    language: str
+    result: Optional[AnalysisResponse] = None
+    error: Optional[str] = None
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    expires_at: float
+
 class TranslationRequest(BaseModel):
     text: str
     target_language: str
@@ -71,7 +194,7 @@ class TranslationRequest(BaseModel):
 @app.on_event("startup")
 async def startup_event():
     """Initialize models and services on startup"""
-    global model_loader, prediction_service, openai_service
+    global model_loader, prediction_service, openai_service, single_flight, job_queue, similarity_indexes, session_store, video_service, model_watch_task
     
     print("🚀 Starting up Crop Disease Detection API...")
     
@@ -83,9 +206,24 @@ async def startup_event():
         model_loader = ModelLoader()
         await model_loader.load_models()
         
+        # Follow the ACTIVE pointer so a swap requested on any worker reaches this one
+        if settings.model_watch_interval > 0:
+            model_watch_task = asyncio.create_task(model_loader.watch_active_pointer())
+        
         # Initialize services
-        prediction_service = PredictionService(model_loader)
-        openai_service = OpenAIService(settings.openai_api_key)
+        single_flight = SingleFlight()
+        if settings.similarity_enabled:
+            similarity_indexes = SimilarityIndexes(settings)
+        prediction_service = PredictionService(model_loader, similarity_indexes)
+        openai_service = OpenAIService(settings.openai_api_key, single_flight)
+        session_store = SessionStore(settings, openai_service)
+        video_service = VideoService(settings, model_loader, admission_controller)
+        
+        # Start background workers for asynchronous diagnosis jobs
+        job_queue = JobQueue(
+            settings, upload_service, prediction_service, openai_service, single_flight, admission_controller
+        )
+        job_queue.start()
         
         print("✅ All models and services loaded successfully!")
         
@@ -93,6 +231,14 @@ async def startup_event():
         print(f"❌ Error during startup: {e}")
         raise e
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop background workers; queued jobs are kept in the database"""
+    if model_watch_task is not None:
+        model_watch_task.cancel()
+    if job_queue is not None:
+        await job_queue.stop()
+
 # Health check endpoint for production monitoring
 @app.get("/health")
 async def health_check():
@@ -102,12 +248,31 @@ async def health_check():
         "services": {
             "model_loader": model_loader is not None,
             "prediction_service": prediction_service is not None,
-            "openai_service": openai_service is not None
+            "openai_service": openai_service is not None,
+            "upload_service": upload_service is not None,
+            "job_queue": job_queue is not None
         },
+        "model_version": model_loader.model_version if model_loader else None,
+        "model_swap": model_loader.swap_status if model_loader else None,
+        "execution_profile": model_loader.get_execution_profile() if model_loader else None,
         "environment": os.getenv("ENVIRONMENT", "development")
     }
     return status
 
+# Metrics endpoint for production monitoring
+@app.get("/metrics")
+async def metrics():
+    """Runtime metrics for monitoring"""
+    return {
+        "uploads": upload_service.get_metrics() if upload_service else None,
+        "single_flight": single_flight.get_metrics() if single_flight else None,
+        "jobs": job_queue.get_metrics() if job_queue else None,
+        "similarity_index": similarity_indexes.get_metrics() if similarity_indexes else None,
+        "sessions": session_store.get_metrics() if session_store else None,
+        "video": video_service.get_metrics() if video_service else None,
+        "admission": admission_controller.get_metrics()
+    }
+
 # Root endpoint with API information
 @app.get("/")
 async def root():
@@ -118,78 +283,282 @@ async def root():
         "endpoints": {
             "upload": "/upload-image/",
             "diagnose": "/diagnose/", 
+            "diagnose-tiled": "/diagnose/tiled",
+            "diagnose-video": "/diagnose/video",
+            "jobs": "/jobs/diagnose",
+            "similar": "/similar/",
             "ask": "/ask/",
             "translate": "/translate/",
-            "translate-result": "/translate-result/"
+            "translate-result": "/translate-result/",
+            "session": "/ws/session"
         },
         "supported_languages": ["en", "bn"]
     }
 
+def request_priority(x_priority: Optional[str], default: str = "normal") -> str:
+    """Clients may lower (never raise) their own priority with X-Priority: low"""
+    return "low" if x_priority == "low" else default
+
+def admission_error(e: AdmissionRejectedError) -> HTTPException:
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+async def analyze_upload(image, upload_info: dict, priority: str = "normal") -> dict:
+    """Analyze an uploaded image (in English), sharing the work with concurrent uploads of the same content"""
+    async def analyze():
+        # Only the call doing the work holds an image slot; coalesced callers just wait for it
+        async with admission_controller.admit("image", priority):
+            return await prediction_service.analyze_image(image, upload_info["sha256"])
+    
+    return await single_flight.do(("analyze", model_loader.model_version, upload_info["sha256"]), analyze)
+
+async def store_diagnosis(session: DiagnosisSession, result: dict, priority: str = "normal") -> dict:
+    """Store a diagnosis in a session, holding an LLM slot when it has to be translated"""
+    if session.language == "en":
+        return await session.set_diagnosis(result)
+    async with admission_controller.admit("llm", priority):
+        return await session.set_diagnosis(result)
+
 @app.post("/upload-image/", response_model=AnalysisResponse)
 async def upload_image(
     file: UploadFile = File(...),
-    language: str = Form("en")
+    language: str = Form("en"),
+    x_priority: Optional[str] = Header(None)
 ):
     """
     Basic image analysis endpoint - returns caption, crop, and disease
     Supports language parameter: "en" for English, "bn" for Bengali
+    The returned session_id can be passed to /ask/ instead of a context
     """
-    if not file.content_type.startswith("image/"):
+    if file.content_type and not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="File must be an image")
     
+    priority = request_priority(x_priority)
     try:
-        # Save uploaded file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp_file:
-            content = await file.read()
-            tmp_file.write(content)
-            tmp_file_path = tmp_file.name
-        
-        # Get predictions
-        result = await prediction_service.analyze_image(tmp_file_path)
+        # Stream the upload into a bounded buffer, rejecting bad input early;
+        # the buffer is counted as in flight until the analysis is done with it
+        async with upload_service.read_image(file) as (image, upload_info):
+            with stage("upload_image.analyze"):
+                result = await analyze_upload(image, upload_info, priority)
         
-        # Translate if Bengali is requested
-        if language == "bn":
-            result = await openai_service.translate_analysis_result(result, "bn")
+        # Start a session so follow-up questions don't resend the context
+        # (translates the result if Bengali is requested); it is only
+        # registered once it holds a diagnosis
+        session = session_store.build(language)
+        with stage("upload_image.translate"):
+            result = await store_diagnosis(session, result, priority)
+        session_store.register(session)
         
-        # Clean up temp file
-        os.unlink(tmp_file_path)
-        
-        return AnalysisResponse(**result)
+        return AnalysisResponse(**result, session_id=session.session_id)
         
+    except UploadRejectedError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except AdmissionRejectedError as e:
+        raise admission_error(e)
     except Exception as e:
-        # Clean up temp file if it exists
-        if 'tmp_file_path' in locals():
-            try:
-                os.unlink(tmp_file_path)
-            except:
-                pass
         raise HTTPException(status_code=500, detail=f"Image processing failed: {str(e)}")
 
 @app.post("/diagnose/", response_model=AnalysisResponse)
 async def diagnose_image(
     file: UploadFile = File(...),
-    language: str = Form("en")
+    language: str = Form("en"),
+    x_priority: Optional[str] = Header(None)
 ):
     """
     Enhanced diagnosis endpoint - same as upload-image but can be extended
     Supports language parameter: "en" for English, "bn" for Bengali
     """
-    return await upload_image(file, language)
+    return await upload_image(file, language, x_priority)
+
+@app.post("/diagnose/tiled", response_model=TiledAnalysisResponse)
+async def diagnose_image_tiled(
+    file: UploadFile = File(...),
+    language: str = Form("en"),
+    x_priority: Optional[str] = Header(None)
+):
+    """
+    High-resolution diagnosis - classifies overlapping tiles of the full image in one batch
+    Returns the image-level diagnosis plus a rows x cols heatmap of disease probability
+    """
+    if file.content_type and not file.content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="File must be an image")
+    
+    priority = request_priority(x_priority)
+    
+    async def analyze_tiled(image):
+        async with admission_controller.admit("image", priority):
+            return await prediction_service.analyze_image_tiled(image)
+    
+    try:
+        async with upload_service.read_image(file) as (image, upload_info):
+            with stage("diagnose_tiled.analyze"):
+                result = await single_flight.do(
+                    ("analyze_tiled", model_loader.model_version, upload_info["sha256"]),
+                    lambda: analyze_tiled(image)
+                )
+        
+        session = session_store.build(language)
+        with stage("diagnose_tiled.translate"):
+            result = await store_diagnosis(session, result, priority)
+        session_store.register(session)
+        
+        return TiledAnalysisResponse(**result, session_id=session.session_id)
+        
+    except UploadRejectedError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except AdmissionRejectedError as e:
+        raise admission_error(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Image processing failed: {str(e)}")
+
+@app.post("/diagnose/video", response_model=VideoAnalysisResponse)
+async def diagnose_video(
+    file: UploadFile = File(...),
+    language: str = Form("en"),
+    x_priority: Optional[str] = Header(None)
+):
+    """
+    Video / burst-capture diagnosis - returns a timeline of crop/disease segments
+    Frames are decoded one at a time, sampled, deduplicated and classified in batches
+    """
+    if file.content_type and not file.content_type.startswith("video/"):
+        raise HTTPException(status_code=400, detail="File must be a video")
+    
+    if language not in SUPPORTED_LANGUAGES:
+        raise HTTPException(status_code=400, detail=f"Supported languages: {', '.join(SUPPORTED_LANGUAGES)}")
+    
+    try:
+        # Videos queue behind single images by default; the slot is taken per model batch, not for the decode
+        with stage("diagnose_video.analyze"):
+            result = await video_service.analyze_video(file, request_priority(x_priority, "low"))
+        
+        if language != "en":
+            # Segments repeat the same labels, so most of these coalesce into a few upstream calls
+            with stage("diagnose_video.translate"):
+                async with admission_controller.admit("llm", request_priority(x_priority)):
+                    summary, *segments = await asyncio.gather(
+                        openai_service.translate_analysis_result(
+                            {"crop": result["crop"], "disease": result["disease"]}, language
+                        ),
+                        *(openai_service.translate_analysis_result(segment, language) for segment in result["segments"])
+                    )
+            result = {**result, **summary, "segments": segments}
+        
+        return VideoAnalysisResponse(**result)
+        
+    except UploadRejectedError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except AdmissionRejectedError as e:
+        raise admission_error(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Video processing failed: {str(e)}")
+
+@app.post("/similar/", response_model=SimilarCasesResponse)
+async def find_similar_cases(
+    file: UploadFile = File(...),
+    k: int = Form(5),
+    x_priority: Optional[str] = Header(None)
+):
+    """
+    Find previously diagnosed images that look like the uploaded one
+    Returns the top-k past cases ranked by embedding similarity
+    """
+    if similarity_indexes is None:
+        raise HTTPException(status_code=503, detail="Similar case search is disabled")
+    
+    if file.content_type and not file.content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="File must be an image")
+    
+    if not 1 <= k <= 50:
+        raise HTTPException(status_code=400, detail="k must be between 1 and 50")
+    
+    try:
+        async with upload_service.read_image(file) as (image, upload_info):
+            async with admission_controller.admit("image", request_priority(x_priority, "low")):
+                cases = await prediction_service.find_similar(image, k, exclude_image=upload_info["sha256"])
+        return SimilarCasesResponse(cases=[SimilarCase(**case) for case in cases])
+        
+    except UploadRejectedError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except AdmissionRejectedError as e:
+        raise admission_error(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Similar case search failed: {str(e)}")
+
+@app.post("/jobs/diagnose", response_model=JobResponse, status_code=202)
+async def submit_diagnosis_job(
+    file: UploadFile = File(...),
+    language: str = Form("en"),
+    priority: str = Form("normal"),
+    callback_url: Optional[str] = Form(None)
+):
+    """
+    Queue an image for diagnosis and return a job id immediately
+    Poll GET /jobs/{job_id} for the result, or pass callback_url to receive it as a webhook
+    """
+    if file.content_type and not file.content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="File must be an image")
+    
+    if priority not in PRIORITY_LANES:
+        raise HTTPException(status_code=400, detail=f"Supported priorities: {', '.join(PRIORITY_LANES)}")
+    
+    if language not in SUPPORTED_LANGUAGES:
+        raise HTTPException(status_code=400, detail=f"Supported languages: {', '.join(SUPPORTED_LANGUAGES)}")
+    
+    try:
+        async with upload_service.read_upload(file) as (image_bytes, upload_info):
+            job = await job_queue.submit(image_bytes, upload_info["sha256"], language, priority, callback_url)
+        return JobResponse(**job)
+        
+    except UploadRejectedError as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to queue job: {str(e)}")
+
+@app.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_diagnosis_job(job_id: str):
+    """
+    Get the status (and result, once completed) of a diagnosis job
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired")
+    return JobResponse(**job)
 
 @app.post("/ask/", response_model=QuestionResponse)
 async def ask_question(
     question: str = Form(...),
     context: Optional[str] = Form(None),
-    language: str = Form("en")
+    language: str = Form("en"),
+    session_id: Optional[str] = Form(None)
 ):
     """
     Ask questions about the analyzed image using GPT
     Supports both Bengali and English questions and responses
+    With session_id (from /diagnose/) the stored diagnosis and history are used and context is ignored
     """
     if not question.strip():
         raise HTTPException(status_code=400, detail="Question cannot be empty")
     
+    if language not in SUPPORTED_LANGUAGES:
+        raise HTTPException(status_code=400, detail=f"Supported languages: {', '.join(SUPPORTED_LANGUAGES)}")
+    
+    session = None
+    if session_id:
+        session = session_store.get(session_id)
+        if session is None:
+            raise HTTPException(status_code=404, detail="Session not found or expired")
+    
     try:
+        if session is not None:
+            # Retries of the same question in a session share one answer (and one history entry)
+            entry = await single_flight.do(
+                ("session_ask", session_id, language, normalize_text(question)),
+                lambda: session.ask(question, language)
+            )
+            return QuestionResponse(answer=entry["answer"])
+        
         answer = await openai_service.ask_question_with_consistency(question, context, language)
         return QuestionResponse(answer=answer)
         
@@ -239,6 +608,123 @@ async def translate_analysis_result(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Translation failed: {str(e)}")
 
+def require_admin_token(token: Optional[str]):
+    """Reject requests that don't carry the configured admin token"""
+    admin_token = get_settings().admin_token
+    if not admin_token:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled (ADMIN_TOKEN is not set)")
+    if not token or not hmac.compare_digest(token.encode(), admin_token.encode()):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+@app.get("/admin/model")
+async def get_model_status(x_admin_token: Optional[str] = Header(None)):
+    """Active classifier version, available versions and the state of the last swap"""
+    require_admin_token(x_admin_token)
+    return {
+        "active_version": model_loader.model_version,
+        "active_pointer": model_loader.read_active_pointer(),
+        "available_versions": model_loader.list_model_versions(),
+        "swap": model_loader.swap_status
+    }
+
+@app.post("/admin/model/swap", status_code=202)
+async def swap_model(request: ModelSwapRequest, x_admin_token: Optional[str] = Header(None)):
+    """
+    Load a classifier version in the background and swap it in once warmed up
+    The version is recorded in the ACTIVE pointer, so every worker process follows within MODEL_WATCH_INTERVAL
+    The current version keeps serving meanwhile; poll GET /admin/model for progress
+    """
+    require_admin_token(x_admin_token)
+    try:
+        return model_loader.activate_version(request.version)
+    except ModelSwapInProgressError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+@app.websocket("/ws/session")
+async def session_socket(websocket: WebSocket):
+    """
+    One connection per farmer session: diagnose, ask follow-ups and switch language
+    without re-sending the image or context. Messages:
+    - binary frame: image to diagnose -> {"type": "diagnosis", "session_id": ..., "result": {...}}
+    - {"type": "ask", "question": "..."} -> {"type": "answer", "question": ..., "answer": ...}
+    - {"type": "language", "language": "bn"} -> {"type": "state", "result": {...}, "history": [...]}
+    - {"type": "ping"} -> {"type": "pong"}
+    An optional "id" on a text message is echoed back on its reply.
+    """
+    await websocket.accept()
+    # Only registered once it holds a diagnosis, so idle connections don't fill the session store
+    session = session_store.build(websocket.query_params.get("language", "en"))
+    
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            
+            if session.result_en is not None:
+                session_store.touch(session)
+            request_id = None
+            try:
+                if message.get("bytes") is not None:
+                    async with upload_service.read_image(BytesUpload(message["bytes"])) as (image, upload_info):
+                        result_en = await analyze_upload(image, upload_info)
+                    result = await store_diagnosis(session, result_en)
+                    session_store.register(session)
+                    reply = {"type": "diagnosis", "language": session.language, "session_id": session.session_id, "result": result}
+                else:
+                    data = json.loads(message.get("text") or "{}")
+                    if not isinstance(data, dict):
+                        raise ValueError("Messages must be JSON objects")
+                    request_id = data.get("id")
+                    reply = await handle_session_message(session, data)
+                
+            except UploadRejectedError as e:
+                reply = {"type": "error", "status": e.status_code, "detail": e.detail}
+            except AdmissionRejectedError as e:
+                reply = {"type": "error", "status": 503, "detail": str(e), "retry_after": e.retry_after}
+            except ValueError as e:
+                reply = {"type": "error", "status": 400, "detail": str(e)}
+            except Exception as e:
+                reply = {"type": "error", "status": 500, "detail": f"Session request failed: {str(e)}"}
+            
+            if request_id is not None:
+                reply["id"] = request_id
+            await websocket.send_json(reply)
+            
+    except WebSocketDisconnect:
+        pass
+
+async def handle_session_message(session: DiagnosisSession, data: dict) -> dict:
+    """Handle one JSON message on a session socket and build its reply"""
+    message_type = data.get("type")
+    
+    if message_type == "ping":
+        return {"type": "pong"}
+    
+    if message_type == "ask":
+        question = (data.get("question") or "").strip()
+        if not question:
+            raise ValueError("Question cannot be empty")
+        if session.result_en is None:
+            raise ValueError("Send an image before asking questions")
+        async with admission_controller.admit("llm", "normal"):
+            entry = await session.ask(question)
+        return {"type": "answer", "language": session.language, **entry}
+    
+    if message_type == "language":
+        async with admission_controller.admit("llm", "normal"):
+            await session.set_language(data.get("language"))
+        return {
+            "type": "state",
+            "language": session.language,
+            "result": session.result,
+            "history": session.get_history()
+        }
+    
+    raise ValueError(f"Unknown message type: {message_type}")
+
 if __name__ == "__main__":
     uvicorn.run(
         "main:app",
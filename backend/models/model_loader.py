@@ -3,6 +3,10 @@ Model loader for all ML models used in the application
 """
 
 import os
+import re
+import math
+import time
+import contextlib
 import torch
 from PIL import Image
 from transformers import (
@@ -17,11 +21,44 @@ from transformers import (
 from torchvision import transforms
 import asyncio
 
+
+# File in model_versions_dir naming the version every worker process should serve
+ACTIVE_POINTER = "ACTIVE"
+
+
+class ModelSwapInProgressError(Exception):
+    """Raised when a model swap is requested while another one is still loading"""
+
+
+def _version_sort_key(name: str) -> list:
+    # Natural order, so v10 sorts after v9
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name)]
+
+
 class ModelLoader:
-    def __init__(self):
+    def __init__(self, settings=None):
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         print(f"🔧 Using device: {self.device}")
         
+        if settings is None:
+            from config.settings import get_settings
+            settings = get_settings()
+        self.settings = settings
+        
+        # Execution profile (see Settings); bf16 is only enabled where the hardware supports it
+        self.use_inference_mode = settings.inference_mode
+        self.use_bf16 = settings.bf16_autocast and self._bf16_supported()
+        self.use_channels_last = settings.channels_last
+        self.use_compile = settings.compile_models and hasattr(torch, "compile")
+        self.warmup_seconds = None
+        print(f"⚙️ Execution profile: {self.get_execution_profile()}")
+        
+        # Hot-swap state; the classifier itself carries its version (crop_model.model_version)
+        self.swap_status = {"state": "idle", "target": None, "error": None, "seconds": None}
+        self._swap_task = None
+        # Last ACTIVE pointer value this process acted on
+        self._active_pointer = None
+        
         # Model components
         self.crop_model = None
         self.crop_processor = None
@@ -38,27 +75,302 @@ class ModelLoader:
             transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
         ])
     
-    async def load_models(self):
-        """Load all required models"""
+    async def load_models(self, captioning: bool = True):
+        """Load all required models (captioning models can be skipped for classify-only use)"""
         print("📦 Loading models...")
         
         # Load crop disease classification model
-        await self._load_crop_model()
+        self.crop_processor, self.crop_model = self._load_startup_model()
+        version = self.model_version
         
         # Load captioning models
-        await self._load_captioning_models()
+        if captioning:
+            await self._load_captioning_models()
+        
+        self._optimize_models()
+        
+        if self.settings.warmup_enabled:
+            self.warmup()
+        
+        print(f"✅ All models loaded successfully! (classifier version {version})")
+    
+    @property
+    def model_version(self):
+        """Version of the classifier currently serving new requests"""
+        return getattr(self.crop_model, "model_version", None)
+    
+    def list_model_versions(self) -> list:
+        """Version directories under model_versions_dir, oldest to newest"""
+        root = self.settings.model_versions_dir
+        if not os.path.isdir(root):
+            return []
+        names = [name for name in os.listdir(root) if os.path.isfile(os.path.join(root, name, "config.json"))]
+        return sorted(names, key=_version_sort_key)
+    
+    def resolve_model_path(self, version: str = None) -> tuple:
+        """
+        Map a version name to (model directory, version)
+        Without a version, the newest versioned directory is used, or swin_model_path if there are none
+        """
+        versions = self.list_model_versions()
+        if version:
+            if version not in versions:
+                raise FileNotFoundError(f"Model version not found: {version}")
+            return os.path.join(self.settings.model_versions_dir, version), version
+        if versions:
+            return os.path.join(self.settings.model_versions_dir, versions[-1]), versions[-1]
+        
+        model_path = self._default_model_path()
+        return model_path, os.path.basename(os.path.normpath(model_path))
+    
+    def _load_startup_model(self) -> tuple:
+        """
+        Load the classifier to serve at startup: the ACTIVE pointer wins over MODEL_VERSION,
+        which wins over the newest version. A version taken from the pointer or picked as
+        newest must load with its trained weights; otherwise the next candidate is tried.
+        """
+        self._active_pointer = self.read_active_pointer()
+        if self._active_pointer:
+            try:
+                model_path, version = self.resolve_model_path(self._active_pointer)
+                return self._load_crop_model(model_path, version, allow_fallback=False)
+            except Exception as e:
+                print(f"⚠️ {ACTIVE_POINTER} version {self._active_pointer} could not be loaded ({e}), falling back")
+        
+        if self.settings.model_version:
+            model_path, version = self.resolve_model_path(self.settings.model_version)
+            return self._load_crop_model(model_path, version)
+        
+        for version in reversed(self.list_model_versions()):
+            if version == self._active_pointer:
+                continue
+            try:
+                model_path, version = self.resolve_model_path(version)
+                return self._load_crop_model(model_path, version, allow_fallback=False)
+            except Exception as e:
+                print(f"⚠️ Model version {version} could not be loaded ({e}), trying an older one")
+        
+        model_path = self._default_model_path()
+        return self._load_crop_model(model_path, os.path.basename(os.path.normpath(model_path)))
+    
+    def activate_version(self, version: str = None) -> dict:
+        """
+        Make a version active in every worker process: swap it in here and, once it has
+        loaded and warmed up, record it in the ACTIVE pointer file that the other workers'
+        watchers follow. A failed swap leaves the pointer on the previous version.
+        """
+        self._check_swap_idle()
+        versions = self.list_model_versions()
+        if not versions:
+            raise FileNotFoundError(f"No model versions under {self.settings.model_versions_dir}")
+        version = version or versions[-1]
+        if version not in versions:
+            raise FileNotFoundError(f"Model version not found: {version}")
+        
+        return self.start_swap(version, publish=True)
+    
+    def read_active_pointer(self):
+        """Version named by the ACTIVE pointer file, or None"""
+        try:
+            with open(os.path.join(self.settings.model_versions_dir, ACTIVE_POINTER)) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+    
+    async def watch_active_pointer(self):
+        """Poll the ACTIVE pointer and swap in whatever version it names (runs until cancelled)"""
+        while True:
+            await asyncio.sleep(self.settings.model_watch_interval)
+            version = None
+            try:
+                version = await asyncio.to_thread(self.read_active_pointer)
+                if version and version != self._active_pointer:
+                    print(f"👀 {ACTIVE_POINTER} now names version {version}")
+                    self.start_swap(version)
+                    self._active_pointer = version
+            except ModelSwapInProgressError:
+                pass  # Picked up again on the next check
+            except Exception as e:
+                print(f"⚠️ Could not follow {ACTIVE_POINTER} pointer: {e}")
+                # Don't retry (and log) the same bad value every interval
+                self._active_pointer = version
+    
+    def start_swap(self, version: str = None, publish: bool = False) -> dict:
+        """
+        Load a classifier version in the background, warm it up and swap it in
+        Must be called on the event loop. Requests already running keep the model they started with.
+        Only affects this process unless publish is set; use activate_version to reach every worker.
+        """
+        self._check_swap_idle()
+        
+        model_path, version = self.resolve_model_path(version)
+        self.swap_status = {"state": "loading", "target": version, "error": None, "seconds": None}
+        self._swap_task = asyncio.ensure_future(asyncio.to_thread(self._swap_model, model_path, version, publish))
+        return dict(self.swap_status)
+    
+    def _check_swap_idle(self):
+        if self._swap_task is not None and not self._swap_task.done():
+            raise ModelSwapInProgressError(f"Model version {self.swap_status['target']} is still loading")
+    
+    def _write_active_pointer(self, version: str):
+        # Write then rename, so a watcher never reads a half-written pointer
+        pointer_path = os.path.join(self.settings.model_versions_dir, ACTIVE_POINTER)
+        temp_path = f"{pointer_path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(version + "\n")
+        os.replace(temp_path, pointer_path)
+        self._active_pointer = version
+    
+    def _swap_model(self, model_path: str, version: str, publish: bool = False):
+        print(f"🔄 Loading classifier version {version} in the background...")
+        start = time.perf_counter()
+        try:
+            # No fallback here: an untrained model must never replace a working one
+            processor, model = self._load_crop_model(model_path, version, allow_fallback=False)
+            model = self._optimize_classifier(model)
+            if self.settings.warmup_enabled and not self.use_compile:
+                # A compiled classifier was already warmed up while compiling
+                self._warmup_classifier(model)
+            
+            # A single reference assignment; in-flight requests hold on to the old model until they finish
+            self.crop_processor, self.crop_model = processor, model
+            self.swap_status = {
+                "state": "ready", "target": version, "error": None,
+                "seconds": round(time.perf_counter() - start, 3)
+            }
+            print(f"✅ Classifier version {version} is now active")
+            
+            # Only a version that actually loaded is handed to the other workers
+            if publish:
+                try:
+                    self._write_active_pointer(version)
+                except OSError as e:
+                    print(f"⚠️ Could not update {ACTIVE_POINTER} pointer, other workers keep their version: {e}")
+        except Exception as e:
+            self.swap_status = {"state": "failed", "target": version, "error": str(e), "seconds": None}
+            print(f"❌ Swapping to classifier version {version} failed: {e}")
+    
+    def get_execution_profile(self) -> dict:
+        """Return the active execution options"""
+        return {
+            "device": self.device,
+            "inference_mode": self.use_inference_mode,
+            "bf16_autocast": self.use_bf16,
+            "channels_last": self.use_channels_last,
+            "compile": self.use_compile,
+            "warmup_seconds": self.warmup_seconds,
+        }
+    
+    def _bf16_supported(self) -> bool:
+        """Check whether bf16 autocast is worthwhile on this device"""
+        if self.device == "cuda":
+            return torch.cuda.is_bf16_supported()
+        # Only CPUs with native bf16 instructions (AVX512-BF16 / AMX) benefit
+        for check in ("_is_amx_tile_supported", "_is_avx512_bf16_supported"):
+            fn = getattr(torch.cpu, check, None)
+            if fn is not None and fn():
+                return True
+        return False
+    
+    def _inference_context(self):
+        """Context for all forward passes: inference_mode/no_grad plus optional bf16 autocast"""
+        stack = contextlib.ExitStack()
+        stack.enter_context(torch.inference_mode() if self.use_inference_mode else torch.no_grad())
+        if self.use_bf16:
+            stack.enter_context(torch.autocast(device_type=self.device, dtype=torch.bfloat16))
+        return stack
+    
+    def _optimize_models(self):
+        """Apply channels-last layout and torch.compile to the hot models"""
+        if self.crop_model is not None:
+            self.crop_model = self._optimize_classifier(self.crop_model)
         
-        print("✅ All models loaded successfully!")
+        if self.blip_model is not None:
+            if self.use_channels_last:
+                self.blip_model.to(memory_format=torch.channels_last)
+            if self.use_compile:
+                self._compile_module(
+                    self.blip_model, "vision_model", "BLIP vision encoder",
+                    lambda: self.generate_blip_caption(Image.new("RGB", (224, 224), color=(90, 140, 60)))
+                )
     
-    async def _load_crop_model(self):
-        """Load the trained SwinV2 crop disease model"""
-        print("🌱 Loading crop disease classification model...")
+    def _optimize_classifier(self, model):
+        """Apply channels-last layout and torch.compile to a classifier"""
+        if self.use_channels_last:
+            model.to(memory_format=torch.channels_last)
         
+        if self.use_compile:
+            # Compile the backbone submodule so both classify paths (with/without embeddings) use it
+            self._compile_module(model, model.base_model_prefix, "classifier", lambda: self._warmup_classifier(model))
+        return model
+    
+    def _compile_module(self, owner, attribute: str, label: str, first_call) -> bool:
+        """
+        torch.compile owner.<attribute> and run first_call through it
+        Compilation is lazy and only fails on the first call, so that call is guarded too;
+        on failure the eager module is put back and compilation is turned off
+        """
+        print(f"🛠️ Compiling {label}...")
+        eager_module = getattr(owner, attribute)
+        start = time.perf_counter()
+        try:
+            setattr(owner, attribute, torch.compile(eager_module, dynamic=True))
+            first_call()
+        except Exception as e:
+            setattr(owner, attribute, eager_module)
+            print(f"⚠️ torch.compile of {label} failed, continuing in eager mode: {e}")
+            self.use_compile = False
+            return False
+        print(f"✅ Compiled {label} in {time.perf_counter() - start:.1f}s")
+        return True
+    
+    def warmup(self):
+        """
+        Run synthetic batches so lazy initialization happens before the first request
+        Compiled models were already warmed up by their first (compiling) call
+        """
+        if self.use_compile:
+            return
+        print("🔥 Warming up models...")
+        start = time.perf_counter()
+        
+        self._warmup_classifier(self.crop_model)
+        if self.blip_model is not None:
+            self.generate_blip_caption(Image.new("RGB", (224, 224), color=(90, 140, 60)))
+        
+        self.warmup_seconds = round(time.perf_counter() - start, 3)
+        print(f"✅ Warmup finished in {self.warmup_seconds}s")
+    
+    def _warmup_classifier(self, model):
+        image = Image.new("RGB", (224, 224), color=(90, 140, 60))
+        for batch_size in sorted({1, self.settings.warmup_batch_size}):
+            batch = torch.stack([self.transform(image)] * batch_size).to(self.device)
+            for _ in range(self.settings.warmup_iterations):
+                self.classify_tensor(batch, model=model)
+    
+    def classify_tensor(self, batch: torch.Tensor, return_embeddings: bool = False, model=None):
+        """
+        Run the classifier on a normalized (N, 3, 224, 224) batch and return fp32 logits
+        With return_embeddings, also return the pooled penultimate features as (logits, embeddings)
+        Pass model to pin a specific classifier version (defaults to the active one)
+        """
+        model = self.crop_model if model is None else model
+        if self.use_channels_last:
+            batch = batch.contiguous(memory_format=torch.channels_last)
+        with self._inference_context():
+            if return_embeddings:
+                backbone = getattr(model, model.base_model_prefix)
+                pooled = backbone(pixel_values=batch).pooler_output
+                logits = model.classifier(pooled)
+                return logits.float(), pooled.float()
+            outputs = model(batch)
+        return outputs.logits.float()
+    
+    def _default_model_path(self) -> str:
+        """Unversioned model directory from settings, with fallbacks for other layouts"""
         # Get model path from settings or use relative path
         try:
-            from config.settings import get_settings
-            settings = get_settings()
-            model_path = settings.swin_model_path
+            return self.settings.swin_model_path
         except:
             # Fallback to multiple possible paths
             possible_paths = [
@@ -68,18 +380,19 @@ class ModelLoader:
                 "/var/task/backend/swinv2_tiny_crop_disease"  # Vercel serverless path
             ]
             
-            model_path = None
             for path in possible_paths:
                 if os.path.exists(path):
-                    model_path = path
-                    print(f"✅ Found model at: {model_path}")
-                    break
+                    print(f"✅ Found model at: {path}")
+                    return path
             
-            if not model_path:
-                print(f"❌ Model not found in any of these paths: {possible_paths}")
-                print(f"📁 Current working directory: {os.getcwd()}")
-                print(f"📁 Available files: {os.listdir('.')}")
-                raise FileNotFoundError("Trained model directory not found")
+            print(f"❌ Model not found in any of these paths: {possible_paths}")
+            print(f"📁 Current working directory: {os.getcwd()}")
+            print(f"📁 Available files: {os.listdir('.')}")
+            raise FileNotFoundError("Trained model directory not found")
+    
+    def _load_crop_model(self, model_path: str, version: str, allow_fallback: bool = True) -> tuple:
+        """Load a trained SwinV2 crop disease model; returns (processor, model) tagged with its version"""
+        print(f"🌱 Loading crop disease classification model (version {version})...")
         
         if not os.path.exists(model_path):
             print(f"❌ Model path does not exist: {model_path}")
@@ -98,36 +411,41 @@ class ModelLoader:
         if missing_files:
             print(f"❌ CRITICAL: Missing trained model files: {missing_files}")
             print(f"📁 Current files in {model_path}: {os.listdir(model_path)}")
+            if not allow_fallback:
+                raise FileNotFoundError(f"Missing trained model files: {missing_files}")
             print("🚨 The system will fall back to base model, which will give INCORRECT predictions!")
             print("� Solution: Please provide the trained model weights (model.safetensors)")
             
             # Fallback with clear warning
-            await self._load_fallback_model(model_path)
-            return
+            return self._load_fallback_model(model_path, version)
         
         try:
             # Load model and processor with your trained weights
             print("📦 Loading trained model weights...")
             
-            self.crop_processor = AutoImageProcessor.from_pretrained(model_path)
-            self.crop_model = AutoModelForImageClassification.from_pretrained(
+            processor = AutoImageProcessor.from_pretrained(model_path)
+            model = AutoModelForImageClassification.from_pretrained(
                 model_path,
                 local_files_only=True,
                 trust_remote_code=True
             )
             
-            self.crop_model.to(self.device)
-            self.crop_model.eval()
+            model.to(self.device)
+            model.eval()
+            model.model_version = version
             
-            print(f"✅ TRAINED crop model loaded successfully with {len(self.crop_model.config.id2label)} classes")
-            print(f"📝 Sample classes: {list(self.crop_model.config.id2label.values())[:5]}")
+            print(f"✅ TRAINED crop model loaded successfully with {len(model.config.id2label)} classes")
+            print(f"📝 Sample classes: {list(model.config.id2label.values())[:5]}")
+            return processor, model
             
         except Exception as e:
             print(f"❌ Error loading trained model: {e}")
+            if not allow_fallback:
+                raise e
             print("🔄 Falling back to base model...")
-            await self._load_fallback_model(model_path)
+            return self._load_fallback_model(model_path, version)
     
-    async def _load_fallback_model(self, model_path):
+    def _load_fallback_model(self, model_path: str, version: str) -> tuple:
         """Load fallback model when trained weights are missing"""
         print("⚠️ WARNING: Using untrained base model - predictions will be INCORRECT!")
         
@@ -146,18 +464,20 @@ class ModelLoader:
             custom_config.id2label = config_data["id2label"]
             custom_config.label2id = {v: k for k, v in config_data["id2label"].items()}
             
-            self.crop_processor = AutoImageProcessor.from_pretrained("microsoft/swin-tiny-patch4-window7-224")
-            self.crop_model = AutoModelForImageClassification.from_pretrained(
+            processor = AutoImageProcessor.from_pretrained("microsoft/swin-tiny-patch4-window7-224")
+            model = AutoModelForImageClassification.from_pretrained(
                 "microsoft/swin-tiny-patch4-window7-224",
                 config=custom_config,
                 ignore_mismatched_sizes=True
             )
             
-            self.crop_model.to(self.device)
-            self.crop_model.eval()
+            model.to(self.device)
+            model.eval()
+            model.model_version = version
             
             print("❌ FALLBACK model loaded - PREDICTIONS WILL BE RANDOM/INCORRECT!")
-            print("📝 Configured classes:", list(self.crop_model.config.id2label.values())[:5])
+            print("📝 Configured classes:", list(model.config.id2label.values())[:5])
+            return processor, model
             
         except Exception as e:
             print(f"❌ Even fallback model failed: {e}")
@@ -239,7 +559,7 @@ class ModelLoader:
         
         try:
             inputs = self.blip_processor(image, return_tensors="pt").to(self.device)
-            with torch.no_grad():
+            with self._inference_context():
                 out = self.blip_model.generate(**inputs, max_length=50)
             return self.blip_processor.decode(out[0], skip_special_tokens=True)
         except Exception as e:
@@ -253,24 +573,27 @@ class ModelLoader:
         
         try:
             pixel_values = self.vit_processor(images=image, return_tensors="pt").pixel_values.to(self.device)
-            with torch.no_grad():
+            with self._inference_context():
                 out = self.vit_model.generate(pixel_values, max_length=50)
             return self.vit_tokenizer.decode(out[0], skip_special_tokens=True)
         except Exception as e:
             print(f"Error in ViT caption generation: {e}")
             return "Plant leaf showing characteristics for agricultural analysis"
     
-    def predict_crop_and_disease(self, image: Image.Image) -> tuple:
-        """Predict crop type and disease from image"""
-        
-        if self.crop_model is None:
+    def predict_crop_and_disease(self, image: Image.Image, return_embedding: bool = False, model=None) -> tuple:
+        """
+        Predict crop type and disease from image
+        With return_embedding, returns (crop, disease, embedding) where embedding is a NumPy vector
+        """
+        model = self.crop_model if model is None else model
+        if model is None:
             raise Exception("Model not loaded properly")
         
         # Check if we're using the fallback model
-        is_trained_model = hasattr(self.crop_model, '_is_trained_model')
+        is_trained_model = hasattr(model, '_is_trained_model')
         if not is_trained_model:
             # Check if this is likely a fallback by examining the model's base config
-            model_name = getattr(self.crop_model.config, '_name_or_path', '')
+            model_name = getattr(model.config, '_name_or_path', '')
             if 'microsoft/swin-tiny-patch4-window7-224' in model_name:
                 print("⚠️ WARNING: Using untrained base model - prediction will be unreliable!")
         
@@ -279,48 +602,38 @@ class ModelLoader:
             img_tensor = self.transform(image).unsqueeze(0).to(self.device)
             
             # Get prediction
-            with torch.no_grad():
-                outputs = self.crop_model(img_tensor)
-                predicted_idx = torch.argmax(outputs.logits, dim=1).item()
-                confidence = torch.softmax(outputs.logits, dim=1).max().item()
-                
-                # Debug: Print the predicted index and available labels
-                print(f"🔍 Predicted index: {predicted_idx}")
-                print(f"🔍 Confidence: {confidence:.3f}")
-                print(f"🔍 Available labels count: {len(self.crop_model.config.id2label)}")
-                
-                # Check if using untrained model
-                if 'microsoft/swin-tiny-patch4-window7-224' in model_name:
-                    print("❌ CRITICAL: Prediction made with UNTRAINED model - result is meaningless!")
-                    print("🔧 SOLUTION: Please provide trained model weights (model.safetensors)")
-                
-                # Safely get the class name
-                if predicted_idx in self.crop_model.config.id2label:
-                    class_name = self.crop_model.config.id2label[predicted_idx]
-                    print(f"🔍 Predicted class: {class_name}")
-                else:
-                    print(f"❌ Index {predicted_idx} not found in labels")
-                    # Use a default classification
-                    class_name = "Unknown/Disease"
-            
-            # Split crop/disease
-            if "/" in class_name:
-                crop_name, disease_name = class_name.split("/", 1)
+            if return_embedding:
+                logits, embeddings = self.classify_tensor(img_tensor, return_embeddings=True, model=model)
             else:
-                crop_name, disease_name = class_name, "Healthy"
-            
-            # Clean up any problematic class names
-            if ".ipynb_checkpoints" in disease_name:
-                disease_name = "Healthy"
+                logits = self.classify_tensor(img_tensor, model=model)
+            predicted_idx = torch.argmax(logits, dim=1).item()
+            confidence = torch.softmax(logits, dim=1).max().item()
             
-            print(f"✅ Final result: {crop_name.strip()} / {disease_name.strip()}")
+            # Debug: Print the predicted index and available labels
+            print(f"🔍 Predicted index: {predicted_idx}")
+            print(f"🔍 Confidence: {confidence:.3f}")
+            print(f"🔍 Available labels count: {len(model.config.id2label)}")
             
-            # Add warning for untrained model results
+            # Check if using untrained model
             if 'microsoft/swin-tiny-patch4-window7-224' in model_name:
-                crop_name = f"[UNTRAINED] {crop_name.strip()}"
-                disease_name = f"[UNTRAINED] {disease_name.strip()}"
+                print("❌ CRITICAL: Prediction made with UNTRAINED model - result is meaningless!")
+                print("🔧 SOLUTION: Please provide trained model weights (model.safetensors)")
+            
+            # Safely get the class name
+            if predicted_idx in model.config.id2label:
+                class_name = model.config.id2label[predicted_idx]
+                print(f"🔍 Predicted class: {class_name}")
+            else:
+                print(f"❌ Index {predicted_idx} not found in labels")
+                # Use a default classification
+                class_name = "Unknown/Disease"
             
-            return crop_name.strip(), disease_name.strip()
+            crop_name, disease_name = self._split_class_name(class_name, model)
+            print(f"✅ Final result: {crop_name} / {disease_name}")
+            
+            if return_embedding:
+                return crop_name, disease_name, embeddings[0].cpu().numpy()
+            return crop_name, disease_name
             
         except Exception as e:
             print(f"❌ Error in prediction: {str(e)}")
@@ -328,3 +641,101 @@ class ModelLoader:
             import traceback
             print(f"❌ Full traceback: {traceback.format_exc()}")
             raise e
+    
+    def predict_batch(self, batch: torch.Tensor, model=None) -> list:
+        """
+        Classify a normalized (N, 3, 224, 224) batch in one forward pass
+        Returns a list of (crop, disease, confidence) tuples
+        """
+        model = self.crop_model if model is None else model
+        if model is None:
+            raise Exception("Model not loaded properly")
+        
+        probabilities = torch.softmax(self.classify_tensor(batch.to(self.device), model=model), dim=1)
+        confidences, indices = probabilities.max(dim=1)
+        
+        id2label = model.config.id2label
+        results = []
+        for idx, confidence in zip(indices.tolist(), confidences.tolist()):
+            crop_name, disease_name = self._split_class_name(id2label.get(idx, "Unknown/Disease"), model)
+            results.append((crop_name, disease_name, confidence))
+        return results
+    
+    def get_class_labels(self, model=None) -> list:
+        """(crop, disease) for every class index, in index order"""
+        model = self.crop_model if model is None else model
+        id2label = model.config.id2label
+        return [self._split_class_name(id2label.get(idx, "Unknown/Disease"), model) for idx in range(len(id2label))]
+    
+    def tile_grid(self, width: int, height: int) -> tuple:
+        """
+        Choose overlapping tiles covering a width x height image
+        The tile side grows until the grid fits in max_tiles, so tile count adapts to image size.
+        Returns (boxes, rows, cols) with boxes in row-major order.
+        """
+        tile = self.settings.tile_size
+        if max(width, height) < tile * 1.5:
+            return [(0, 0, width, height)], 1, 1
+        
+        while True:
+            stride = max(1, int(tile * (1 - self.settings.tile_overlap)))
+            cols = 1 if width <= tile else math.ceil((width - tile) / stride) + 1
+            rows = 1 if height <= tile else math.ceil((height - tile) / stride) + 1
+            if rows * cols <= self.settings.max_tiles:
+                break
+            tile = int(tile * 1.25)
+        
+        tile_w, tile_h = min(tile, width), min(tile, height)
+        xs = [round(i * (width - tile_w) / max(cols - 1, 1)) for i in range(cols)]
+        ys = [round(i * (height - tile_h) / max(rows - 1, 1)) for i in range(rows)]
+        boxes = [(x, y, x + tile_w, y + tile_h) for y in ys for x in xs]
+        return boxes, rows, cols
+    
+    def classify_tiles(self, image: Image.Image, boxes: list, model=None):
+        """Classify image regions in batched forward passes; returns an (N, num_classes) NumPy array of probabilities"""
+        model = self.crop_model if model is None else model
+        if model is None:
+            raise Exception("Model not loaded properly")
+        
+        batch_size = self.settings.tile_batch_size
+        probabilities = []
+        for start in range(0, len(boxes), batch_size):
+            batch = torch.stack([self.transform(image.crop(box)) for box in boxes[start:start + batch_size]])
+            logits = self.classify_tensor(batch.to(self.device), model=model)
+            probabilities.append(torch.softmax(logits, dim=1).cpu())
+        return torch.cat(probabilities).numpy()
+    
+    def generate_blip_captions(self, images: list, max_length: int = 50) -> list:
+        """Generate BLIP captions for a list of images in one batched generate call"""
+        if self.blip_model is None or self.blip_processor is None:
+            return ["Image shows agricultural crop for disease analysis"] * len(images)
+        
+        try:
+            inputs = self.blip_processor(images, return_tensors="pt").to(self.device)
+            with self._inference_context():
+                out = self.blip_model.generate(**inputs, max_length=max_length)
+            return self.blip_processor.batch_decode(out, skip_special_tokens=True)
+        except Exception as e:
+            print(f"Error in batched BLIP caption generation: {e}")
+            return ["Agricultural crop image for disease detection"] * len(images)
+    
+    def _split_class_name(self, class_name: str, model=None) -> tuple:
+        """Split a "Crop/Disease" label into cleaned crop and disease names"""
+        model = self.crop_model if model is None else model
+        if "/" in class_name:
+            crop_name, disease_name = class_name.split("/", 1)
+        else:
+            crop_name, disease_name = class_name, "Healthy"
+        
+        # Clean up any problematic class names
+        if ".ipynb_checkpoints" in disease_name:
+            disease_name = "Healthy"
+        
+        crop_name, disease_name = crop_name.strip(), disease_name.strip()
+        
+        # Add warning for untrained model results
+        if 'microsoft/swin-tiny-patch4-window7-224' in getattr(model.config, '_name_or_path', ''):
+            crop_name = f"[UNTRAINED] {crop_name}"
+            disease_name = f"[UNTRAINED] {disease_name}"
+        
+        return crop_name, disease_name
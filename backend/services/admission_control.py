@@ -0,0 +1,223 @@
+"""
+Admission control: per-pool concurrency limits, priority queues and load shedding
+"""
+
+import asyncio
+import contextlib
+import itertools
+import json
+import math
+import time
+from typing import Any, Dict, Tuple
+
+# Lower value = served first, shed last
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+
+class AdmissionRejectedError(Exception):
+    """Raised when a request is shed; retry_after is a hint in seconds"""
+
+    def __init__(self, pool: str, reason: str, retry_after: int):
+        super().__init__(f"Server busy ({pool}: {reason}), retry after {retry_after}s")
+        self.pool = pool
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "future", "enqueued_at")
+
+    def __init__(self, priority: int, seq: int, future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+    @property
+    def rank(self) -> Tuple[int, int]:
+        return self.priority, self.seq
+
+
+class AdmissionPool:
+    """
+    At most `limit` requests run at once. Up to `max_queue` more wait, served by
+    priority then arrival. When the queue is full a lower-priority waiter is
+    dropped to make room, otherwise the newcomer is rejected. Waiters that
+    exceed `queue_deadline` seconds are shed.
+    """
+
+    def __init__(self, name: str, limit: int, max_queue: int, queue_deadline: float):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_deadline = queue_deadline
+
+        self.active = 0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._avg_service = 1.0
+        self._avg_wait = 0.0
+        self.admitted = 0
+        self.shed = {"queue_full": 0, "deadline": 0, "preempted": 0}
+
+    async def acquire(self, priority: str = "normal"):
+        rank = PRIORITIES.get(priority, PRIORITIES["normal"])
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            self.admitted += 1
+            return
+
+        if len(self._waiters) >= self.max_queue:
+            worst = max(self._waiters, key=lambda w: w.rank)
+            if worst.priority <= rank:
+                self.shed["queue_full"] += 1
+                raise AdmissionRejectedError(self.name, "queue full", self.retry_after())
+            # Shed low-priority work first
+            self._waiters.remove(worst)
+            self.shed["preempted"] += 1
+            worst.future.set_exception(AdmissionRejectedError(self.name, "preempted", self.retry_after()))
+
+        waiter = _Waiter(rank, next(self._seq), asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter.future, timeout=self.queue_deadline)
+        except asyncio.TimeoutError:
+            # The slot may have been handed over just as the deadline fired; give it back
+            if self._granted(waiter):
+                self.release(0.0)
+            self._discard(waiter)
+            self.shed["deadline"] += 1
+            raise AdmissionRejectedError(self.name, "queue deadline exceeded", self.retry_after())
+        except asyncio.CancelledError:
+            # Client went away while queued; hand back the slot if it was already granted
+            if self._granted(waiter):
+                self.release(0.0)
+            self._discard(waiter)
+            raise
+
+        wait = time.monotonic() - waiter.enqueued_at
+        self._avg_wait = 0.9 * self._avg_wait + 0.1 * wait
+        self.admitted += 1
+
+    def release(self, service_seconds: float):
+        if service_seconds:
+            self._avg_service = 0.9 * self._avg_service + 0.1 * service_seconds
+        # Hand the slot straight to the best waiter so it can't be taken by a newcomer
+        while self._waiters:
+            waiter = min(self._waiters, key=lambda w: w.rank)
+            self._waiters.remove(waiter)
+            if not waiter.future.done():
+                waiter.future.set_result(None)
+                return
+        self.active -= 1
+
+    def retry_after(self) -> int:
+        """Estimate seconds until a new request would be admitted"""
+        backlog = (len(self._waiters) + 1) * self._avg_service / max(self.limit, 1)
+        return max(1, min(60, math.ceil(backlog)))
+
+    def get_metrics(self) -> Dict[str, Any]:
+        queued = {name: 0 for name in PRIORITIES}
+        names = {value: name for name, value in PRIORITIES.items()}
+        for waiter in self._waiters:
+            queued[names[waiter.priority]] += 1
+        return {
+            "active": self.active,
+            "limit": self.limit,
+            "queue_depth": len(self._waiters),
+            "queue_depth_by_priority": queued,
+            "admitted": self.admitted,
+            "shed": dict(self.shed),
+            "avg_service_seconds": round(self._avg_service, 3),
+            "avg_wait_seconds": round(self._avg_wait, 3),
+        }
+
+    @staticmethod
+    def _granted(waiter: _Waiter) -> bool:
+        future = waiter.future
+        return future.done() and not future.cancelled() and future.exception() is None
+
+    def _discard(self, waiter: _Waiter):
+        if waiter in self._waiters:
+            self._waiters.remove(waiter)
+
+
+class AdmissionController:
+    def __init__(self, settings):
+        self.pools = {
+            "image": AdmissionPool(
+                "image", settings.image_concurrency, settings.image_queue_size, settings.image_queue_deadline
+            ),
+            "llm": AdmissionPool(
+                "llm", settings.llm_concurrency, settings.llm_queue_size, settings.llm_queue_deadline
+            ),
+        }
+
+    @contextlib.asynccontextmanager
+    async def admit(self, pool_name: str, priority: str = "normal"):
+        """Hold a slot in the named pool for the duration of the block"""
+        pool = self.pools[pool_name]
+        await pool.acquire(priority)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            pool.release(time.monotonic() - start)
+
+    @contextlib.contextmanager
+    def admit_blocking(self, pool_name: str, priority: str, loop: asyncio.AbstractEventLoop):
+        """Like admit(), for code running in a worker thread; the pool itself is driven on `loop`"""
+        pool = self.pools[pool_name]
+        asyncio.run_coroutine_threadsafe(pool.acquire(priority), loop).result()
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            loop.call_soon_threadsafe(pool.release, time.monotonic() - start)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {name: pool.get_metrics() for name, pool in self.pools.items()}
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware applying admission control by route before the request body is read.
+    `routes` maps a path to (pool, default priority); other paths pass straight through.
+    Clients may lower their own priority with `X-Priority: low`.
+    """
+
+    def __init__(self, app, controller: AdmissionController, routes: Dict[str, Tuple[str, str]]):
+        self.app = app
+        self.controller = controller
+        self.routes = routes
+
+    async def __call__(self, scope, receive, send):
+        route = self.routes.get(scope.get("path")) if scope["type"] == "http" else None
+        if route is None:
+            await self.app(scope, receive, send)
+            return
+
+        pool_name, priority = route
+        if dict(scope.get("headers", [])).get(b"x-priority") == b"low":
+            priority = "low"
+
+        try:
+            async with self.controller.admit(pool_name, priority):
+                await self.app(scope, receive, send)
+        except AdmissionRejectedError as e:
+            await self._reject(send, e)
+
+    @staticmethod
+    async def _reject(send, error: AdmissionRejectedError):
+        body = json.dumps({"detail": str(error)}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(error.retry_after).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
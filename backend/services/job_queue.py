@@ -0,0 +1,352 @@
+"""
+Durable job queue for asynchronous diagnosis requests
+"""
+
+import asyncio
+import ipaddress
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import httpx
+
+from services.admission_control import AdmissionRejectedError
+from services.session_service import SUPPORTED_LANGUAGES
+
+# Priority lanes, drained in this order
+PRIORITY_LANES = {"high": 0, "normal": 1, "low": 2}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    priority INTEGER NOT NULL,
+    language TEXT NOT NULL,
+    image BLOB,
+    image_sha256 TEXT,
+    callback_url TEXT,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    expires_at REAL NOT NULL,
+    lease_until REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs (status, priority, created_at);
+"""
+
+
+def check_callback_url(url: str, allowed_hosts: List[str]):
+    """
+    Reject webhook targets that could reach internal services: when an allow-list is
+    configured the host must be on it, otherwise every address it resolves to must be public
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ValueError("callback_url must be an http(s) URL")
+
+    host = parts.hostname.lower()
+    if allowed_hosts:
+        if host not in allowed_hosts:
+            raise ValueError(f"callback_url host '{host}' is not allowed")
+        return
+
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, parts.port or 443, proto=socket.IPPROTO_TCP)}
+    except (socket.gaierror, UnicodeError):
+        raise ValueError(f"callback_url host '{host}' could not be resolved")
+
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split("%", 1)[0])
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        if not ip.is_global or ip.is_multicast:
+            raise ValueError(f"callback_url host '{host}' resolves to a non-public address")
+
+
+class JobQueue:
+    def __init__(self, settings, upload_service, prediction_service, openai_service, single_flight,
+                 admission_controller):
+        self.db_path = settings.job_db_path
+        self.num_workers = settings.job_workers
+        self.job_ttl = settings.job_ttl_seconds
+        self.result_ttl = settings.job_result_ttl_seconds
+        self.poll_interval = settings.job_poll_interval
+        self.webhook_timeout = settings.job_webhook_timeout
+        self.webhook_allowed_hosts = [host.lower() for host in settings.job_webhook_allowed_hosts]
+        self.lease_seconds = settings.job_lease_seconds
+
+        self.upload_service = upload_service
+        self.prediction_service = prediction_service
+        self.openai_service = openai_service
+        self.single_flight = single_flight
+        self.admission_controller = admission_controller
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        if "lease_until" not in columns:
+            with self._conn:
+                self._conn.execute("ALTER TABLE jobs ADD COLUMN lease_until REAL")
+
+        self._wakeup = None
+        self._workers = []
+        self._wait_times = deque(maxlen=1000)
+        self._counts = {"submitted": 0, "completed": 0, "failed": 0, "expired": 0, "requeued": 0}
+
+    def start(self):
+        """Start the background workers (call from the running event loop)"""
+        self._wakeup = asyncio.Event()
+        self._workers = [asyncio.create_task(self._worker(i)) for i in range(self.num_workers)]
+        print(f"📬 Job queue started with {self.num_workers} worker(s) at {self.db_path}")
+
+    async def stop(self):
+        """Stop the workers; unfinished jobs stay queued in the database"""
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._conn.close()
+
+    async def submit(self, image_bytes: bytes, image_sha256: str, language: str = "en",
+                     priority: str = "normal", callback_url: Optional[str] = None) -> Dict[str, Any]:
+        """Persist a new diagnosis job and wake a worker"""
+        if priority not in PRIORITY_LANES:
+            raise ValueError(f"Unknown priority '{priority}'. Supported: {', '.join(PRIORITY_LANES)}")
+        if language not in SUPPORTED_LANGUAGES:
+            raise ValueError(f"Unknown language '{language}'. Supported: {', '.join(SUPPORTED_LANGUAGES)}")
+        if callback_url:
+            await asyncio.to_thread(check_callback_url, callback_url, self.webhook_allowed_hosts)
+
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT INTO jobs (id, status, priority, language, image, image_sha256, callback_url, created_at, expires_at) "
+            "VALUES (?, 'queued', ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, PRIORITY_LANES[priority], language, bytes(image_bytes), image_sha256, callback_url, now, now + self.job_ttl),
+        )
+        self._counts["submitted"] += 1
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Return the public view of a job, or None if unknown"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, status, priority, language, result, error, created_at, started_at, finished_at, expires_at "
+                "FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        return self._to_dict(row)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Return queue depth per lane and wait-time statistics"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, priority, COUNT(*) AS n, MIN(created_at) AS oldest FROM jobs GROUP BY status, priority"
+            ).fetchall()
+
+        lane_names = {value: name for name, value in PRIORITY_LANES.items()}
+        depth = {name: 0 for name in PRIORITY_LANES}
+        running = 0
+        oldest_queued = None
+        for row in rows:
+            if row["status"] == "queued":
+                depth[lane_names.get(row["priority"], str(row["priority"]))] = row["n"]
+                oldest_queued = row["oldest"] if oldest_queued is None else min(oldest_queued, row["oldest"])
+            elif row["status"] == "running":
+                running += row["n"]
+
+        waits = sorted(self._wait_times)
+        return {
+            "queue_depth": depth,
+            "running": running,
+            "workers": len(self._workers),
+            "oldest_queued_age_seconds": round(time.time() - oldest_queued, 3) if oldest_queued else 0.0,
+            "wait_seconds_avg": round(sum(waits) / len(waits), 3) if waits else 0.0,
+            "wait_seconds_p95": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else 0.0,
+            **self._counts,
+        }
+
+    async def _worker(self, worker_id: int):
+        while True:
+            try:
+                job, expired = await asyncio.to_thread(self._claim_next)
+                if expired:
+                    await asyncio.gather(*(self._send_webhook(url, self.get(job_id)) for job_id, url in expired))
+                if job is None:
+                    await self._idle()
+                    continue
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Job worker {worker_id} error: {e}")
+                await asyncio.sleep(self.poll_interval)
+
+    async def _idle(self):
+        """Wait for a submission (or the poll interval) and purge old jobs"""
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+        except asyncio.TimeoutError:
+            await asyncio.to_thread(self._purge_finished)
+
+    def _claim_next(self) -> Tuple[Optional[Dict[str, Any]], List[Tuple[str, str]]]:
+        """
+        Atomically move the next queued job to running, expiring stale ones and requeueing
+        running jobs whose worker stopped renewing the lease (it crashed or was killed)
+        Returns the claimed job (or None) and the (id, callback_url) of jobs expired on the way
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            # Take the write lock up front so other processes sharing the database can't claim the same row
+            self._conn.execute("BEGIN IMMEDIATE")
+            requeued = self._conn.execute(
+                "UPDATE jobs SET status = 'queued', started_at = NULL, lease_until = NULL "
+                "WHERE status = 'running' AND (lease_until IS NULL OR lease_until < ?)",
+                (now,),
+            ).rowcount
+            if requeued:
+                print(f"♻️ Requeued {requeued} job(s) whose worker lease expired")
+                self._counts["requeued"] += requeued
+
+            stale = self._conn.execute(
+                "SELECT id, callback_url FROM jobs WHERE status = 'queued' AND expires_at < ?", (now,)
+            ).fetchall()
+            if stale:
+                self._conn.executemany(
+                    "UPDATE jobs SET status = 'expired', image = NULL, finished_at = ?, expires_at = ?, "
+                    "error = 'Job expired before processing' WHERE id = ?",
+                    [(now, now + self.result_ttl, row["id"]) for row in stale],
+                )
+                self._counts["expired"] += len(stale)
+            expired = [(row["id"], row["callback_url"]) for row in stale if row["callback_url"]]
+
+            row = self._conn.execute(
+                "SELECT id, priority, language, image, image_sha256, callback_url, created_at FROM jobs "
+                "WHERE status = 'queued' ORDER BY priority, created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None, expired
+            claimed = self._conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ?, lease_until = ? WHERE id = ? AND status = 'queued'",
+                (now, now + self.lease_seconds, row["id"]),
+            ).rowcount
+            if not claimed:
+                return None, expired
+
+        self._wait_times.append(now - row["created_at"])
+        return dict(row), expired
+
+    async def _heartbeat(self, job_id: str):
+        """Keep extending the lease while the job runs so other workers leave it alone"""
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            await asyncio.to_thread(
+                self._execute,
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND status = 'running'",
+                (time.time() + self.lease_seconds, job_id),
+            )
+
+    async def _run(self, job: Dict[str, Any]):
+        heartbeat = asyncio.create_task(self._heartbeat(job["id"]))
+        try:
+            image = self.upload_service.open_image(job["image"])
+
+            async def analyze():
+                # Background work competes for the same model slots as interactive requests, at low priority
+                async with self.admission_controller.admit("image", "low"):
+                    return await self.prediction_service.analyze_image(image, job["image_sha256"])
+
+            result = await self.single_flight.do(
+                ("analyze", self.prediction_service.model_loader.model_version, job["image_sha256"]), analyze
+            )
+            if job["language"] == "bn":
+                async with self.admission_controller.admit("llm", "low"):
+                    result = await self.openai_service.translate_analysis_result(result, "bn")
+
+            await asyncio.to_thread(self._finish, job["id"], "completed", json.dumps(result), None)
+            self._counts["completed"] += 1
+
+        except AdmissionRejectedError as e:
+            # Shed to make room for interactive traffic: put the job back and back off
+            await asyncio.to_thread(self._requeue, job["id"])
+            print(f"⏳ Job {job['id']} requeued: {e}")
+            await asyncio.sleep(e.retry_after)
+            return
+
+        except Exception as e:
+            await asyncio.to_thread(self._finish, job["id"], "failed", None, str(e))
+            self._counts["failed"] += 1
+
+        finally:
+            heartbeat.cancel()
+
+        if job["callback_url"]:
+            await self._send_webhook(job["callback_url"], self.get(job["id"]))
+
+    def _finish(self, job_id: str, status: str, result: Optional[str], error: Optional[str]):
+        # Drop the image blob once processed; only the result is kept until it expires
+        self._execute(
+            "UPDATE jobs SET status = ?, result = ?, error = ?, image = NULL, finished_at = ?, expires_at = ?, "
+            "lease_until = NULL WHERE id = ?",
+            (status, result, error, time.time(), time.time() + self.result_ttl, job_id),
+        )
+
+    def _requeue(self, job_id: str):
+        self._execute(
+            "UPDATE jobs SET status = 'queued', started_at = NULL, lease_until = NULL WHERE id = ? AND status = 'running'",
+            (job_id,),
+        )
+
+    def _purge_finished(self):
+        self._execute(
+            "DELETE FROM jobs WHERE status IN ('completed', 'failed', 'expired') AND expires_at < ?",
+            (time.time(),),
+        )
+
+    async def _send_webhook(self, url: str, payload: Dict[str, Any]):
+        try:
+            # Checked again at delivery since DNS may have changed since submission
+            await asyncio.to_thread(check_callback_url, url, self.webhook_allowed_hosts)
+            async with httpx.AsyncClient(timeout=self.webhook_timeout) as client:
+                await client.post(url, json=payload)
+        except Exception as e:
+            print(f"⚠️ Webhook delivery to {url} failed: {e}")
+
+    def _execute(self, sql: str, params: tuple = ()):
+        with self._lock, self._conn:
+            self._conn.execute(sql, params)
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+        lane_names = {value: name for name, value in PRIORITY_LANES.items()}
+        return {
+            "job_id": row["id"],
+            "status": row["status"],
+            "priority": lane_names.get(row["priority"], str(row["priority"])),
+            "language": row["language"],
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "error": row["error"],
+            "created_at": row["created_at"],
+            "started_at": row["started_at"],
+            "finished_at": row["finished_at"],
+            "expires_at": row["expires_at"],
+        }
@@ -3,13 +3,30 @@ OpenAI service for handling GPT questions and translation
 """
 
 import asyncio
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
 from openai import OpenAI
+from services.single_flight import SingleFlight, normalize_text
+from services.request_profiler import stage
+
+ASSISTANT_SYSTEM_PROMPT = (
+    "You are an agricultural assistant that helps farmers with crop disease questions. "
+    "Keep answers CONCISE and TO THE POINT: "
+    "- Maximum 2-3 short sentences "
+    "- Start with direct answer "
+    "- Include only essential treatment/prevention steps "
+    "- Avoid lengthy explanations "
+    "- Use simple, clear language "
+    "IMPORTANT: Do NOT use any markdown formatting like **bold** or *italic*. Use plain text only."
+)
+
+# Analysis result fields that are identifiers rather than text for the farmer
+UNTRANSLATED_FIELDS = {"model_version"}
 
 class OpenAIService:
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, single_flight: Optional[SingleFlight] = None):
         self.api_key = api_key
         self.client = None
+        self.single_flight = single_flight or SingleFlight()
         
         if api_key and api_key.strip():
             try:
@@ -37,6 +54,11 @@ class OpenAIService:
             print(f"❌ OpenAI API key test failed: {e}")
             raise e
     
+    async def _create_completion(self, **kwargs):
+        """Run the blocking OpenAI client call in a worker thread so the event loop stays free"""
+        with stage(f"openai.{kwargs.get('model', 'completion')}"):
+            return await asyncio.to_thread(self.client.chat.completions.create, **kwargs)
+    
     async def ask_question(self, question: str, context: Optional[str] = None, language: str = "en") -> str:
         """
         Ask a question using GPT with optional context and language preference
@@ -66,19 +88,10 @@ class OpenAIService:
                     "IMPORTANT: Do NOT use any markdown formatting like **bold** or *italic*. Use plain text only."
                 )
             else:
-                system_content = (
-                    "You are an agricultural assistant that helps farmers with crop disease questions. "
-                    "Keep answers CONCISE and TO THE POINT: "
-                    "- Maximum 2-3 short sentences "
-                    "- Start with direct answer "
-                    "- Include only essential treatment/prevention steps "
-                    "- Avoid lengthy explanations "
-                    "- Use simple, clear language "
-                    "IMPORTANT: Do NOT use any markdown formatting like **bold** or *italic*. Use plain text only."
-                )
+                system_content = ASSISTANT_SYSTEM_PROMPT
             
             # Call OpenAI API
-            response = self.client.chat.completions.create(
+            response = await self._create_completion(
                 model="gpt-4o-mini",
                 messages=[
                     {
@@ -99,10 +112,59 @@ class OpenAIService:
         except Exception as e:
             raise Exception(f"Failed to get GPT response: {str(e)}")
 
+    async def ask_in_session(self, question: str, context: Optional[str], history: List[Tuple[str, str]],
+                             language: str = "en", session_id: Optional[str] = None) -> Tuple[str, str]:
+        """
+        Answer a follow-up question in a diagnosis session
+        The prompt is laid out as a stable prefix (system prompt, diagnosis, earlier turns)
+        followed by the new question, so upstream prompt caching keeps hitting across turns.
+        Returns (english_answer, answer_in_language).
+        """
+        if not self.client:
+            return (
+                self._get_fallback_response(question, context, "en"),
+                self._get_fallback_response(question, context, language)
+            )
+        
+        try:
+            messages = [{"role": "system", "content": ASSISTANT_SYSTEM_PROMPT}]
+            if context:
+                messages.append({"role": "system", "content": f"Diagnosis of the farmer's image:\n{context}"})
+            for previous_question, previous_answer in history:
+                messages.append({"role": "user", "content": previous_question})
+                messages.append({"role": "assistant", "content": previous_answer})
+            messages.append({"role": "user", "content": question})
+            
+            request = {
+                "model": "gpt-4o-mini",
+                "messages": messages,
+                "max_tokens": 150,
+                "temperature": 0.7
+            }
+            if session_id:
+                # Routes a session's requests to the same prompt cache
+                request["extra_body"] = {"prompt_cache_key": session_id}
+            
+            response = await self._create_completion(**request)
+            english_answer = response.choices[0].message.content.strip()
+            
+        except Exception as e:
+            raise Exception(f"Failed to get GPT response: {str(e)}")
+        
+        # Generate in English first for consistency across languages, then translate
+        if language == "en":
+            return english_answer, english_answer
+        return english_answer, await self.translate_text(english_answer, language)
+
     async def translate_text(self, text: str, target_language: str) -> str:
         """
         Translate text to target language
+        Identical concurrent translations share a single upstream call
         """
+        key = ("translate", target_language, normalize_text(text))
+        return await self.single_flight.do(key, lambda: self._translate_text(text, target_language))
+
+    async def _translate_text(self, text: str, target_language: str) -> str:
         if not self.client:
             # Simple fallback - return original text
             return text
@@ -119,7 +181,7 @@ class OpenAIService:
                     "Maintain the original meaning and context. If it's about agriculture, use appropriate English agricultural terms."
                 )
             
-            response = self.client.chat.completions.create(
+            response = await self._create_completion(
                 model="gpt-4o-mini",
                 messages=[
                     {
@@ -176,7 +238,7 @@ class OpenAIService:
         Helper method to get formatted response from GPT
         """
         try:
-            response = self.client.chat.completions.create(
+            response = await self._create_completion(
                 model="gpt-4o-mini",
                 messages=[
                     {
@@ -203,13 +265,15 @@ class OpenAIService:
         Translate analysis result (caption, crop, disease) to target language
         """
         try:
-            translated_result = {}
+            translated_result = dict(result)
             
-            for key, value in result.items():
-                if value and isinstance(value, str):
-                    translated_result[key] = await self.translate_text(value, target_language)
-                else:
-                    translated_result[key] = value
+            # Translate all text fields concurrently
+            keys = [
+                key for key, value in result.items()
+                if value and isinstance(value, str) and key not in UNTRANSLATED_FIELDS
+            ]
+            translations = await asyncio.gather(*(self.translate_text(result[key], target_language) for key in keys))
+            translated_result.update(zip(keys, translations))
             
             return translated_result
             
@@ -219,7 +283,14 @@ class OpenAIService:
     async def ask_question_with_consistency(self, question: str, context: Optional[str] = None, language: str = "en") -> str:
         """
         Ask a question ensuring consistent responses across languages by generating in English first, then translating
+        Identical concurrent questions share a single upstream call
         """
+        key = ("ask", language, normalize_text(question).casefold(), normalize_text(context))
+        return await self.single_flight.do(
+            key, lambda: self._ask_question_with_consistency(question, context, language)
+        )
+
+    async def _ask_question_with_consistency(self, question: str, context: Optional[str] = None, language: str = "en") -> str:
         try:
             # Always generate the response in English first for consistency
             english_answer = await self.ask_question(question, context, "en")
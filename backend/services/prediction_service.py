@@ -3,40 +3,202 @@ Prediction service for handling image analysis
 """
 
 import asyncio
+import numpy as np
+import torch
 from PIL import Image
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Union
 from models.model_loader import ModelLoader
+from services.similarity_index import SimilarityIndexes
+from services.request_profiler import stage
 
 class PredictionService:
-    def __init__(self, model_loader: ModelLoader):
+    def __init__(self, model_loader: ModelLoader, similarity_indexes: Optional[SimilarityIndexes] = None):
         self.model_loader = model_loader
+        self.similarity_indexes = similarity_indexes
     
-    async def analyze_image(self, image_path: str) -> Dict[str, Any]:
+    async def analyze_image(self, image_source: Union[str, Image.Image], image_sha256: Optional[str] = None) -> Dict[str, Any]:
         """
         Analyze image and return caption, crop, and disease
+        Accepts a file path or an already opened PIL image
+        When image_sha256 is given the case is also recorded in the similarity index of the model version
         """
         try:
-            # Load and process image
-            image = Image.open(image_path).convert("RGB")
+            # Run the blocking model calls in a worker thread so the event loop stays free
+            return await asyncio.to_thread(self._analyze_sync, image_source, image_sha256)
             
-            # Get crop and disease prediction
-            crop_name, disease_name = self.model_loader.predict_crop_and_disease(image)
+        except Exception as e:
+            raise Exception(f"Image analysis failed: {str(e)}")
+    
+    async def find_similar(self, image: Image.Image, k: int = 5, exclude_image: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Return the top-k stored cases whose classifier embeddings are closest to this image
+        Only cases recorded by the active classifier version are searched
+        """
+        if self.similarity_indexes is None:
+            raise Exception("Similarity index is not enabled")
+        
+        def embed_and_search():
+            model = self.model_loader.crop_model
+            tensor = self.model_loader.transform(image.convert("RGB")).unsqueeze(0).to(self.model_loader.device)
+            _, embeddings = self.model_loader.classify_tensor(tensor, return_embeddings=True, model=model)
+            index = self.similarity_indexes.for_version(model.model_version)
+            return index.search(embeddings[0].cpu().numpy(), k, exclude_image)
+        
+        return await asyncio.to_thread(embed_and_search)
+    
+    async def analyze_image_tiled(self, image: Image.Image) -> Dict[str, Any]:
+        """
+        Analyze a high-resolution image as overlapping tiles so small lesions are not lost to downscaling
+        Returns the image-level diagnosis plus a coarse per-tile disease heatmap
+        """
+        try:
+            return await asyncio.to_thread(self._analyze_tiled_sync, image)
             
-            # Generate captions
+        except Exception as e:
+            raise Exception(f"Tiled image analysis failed: {str(e)}")
+    
+    def _analyze_tiled_sync(self, image: Image.Image) -> Dict[str, Any]:
+        with stage("analyze_tiled.decode"):
+            image = image.convert("RGB")
+            width, height = image.size
+            boxes, rows, cols = self.model_loader.tile_grid(width, height)
+        
+        # Pin the classifier so a concurrent hot-swap can't change it mid-request
+        model = self.model_loader.crop_model
+        
+        # Whole-image view first, then every tile, all in the same batched pass
+        # (a single tile covering the whole image already is that view)
+        whole_image = [(0, 0, width, height)]
+        with_global = boxes != whole_image
+        views = whole_image + boxes if with_global else boxes
+        with stage("analyze_tiled.classify"):
+            probabilities = self.model_loader.classify_tiles(image, views, model=model)
+        
+        with stage("analyze_tiled.aggregate"):
+            labels = self.model_loader.get_class_labels(model)
+            global_probs, tile_probs = (probabilities[0], probabilities[1:]) if with_global else (None, probabilities)
+            result = self._aggregate_tiles(labels, global_probs, tile_probs, rows, cols)
+        
+        with stage("analyze_tiled.caption"):
             blip_caption = self.model_loader.generate_blip_caption(image)
-            # vit_caption = self.model_loader.generate_vit_caption(image)
-            
-            # Merge captions intelligently
-            merged_caption = self._merge_captions(blip_caption, "")
-            
-            return {
-                "caption": merged_caption,
+        
+        return {
+            "caption": self._merge_captions(blip_caption, ""),
+            **result,
+            "tiles": {"rows": rows, "cols": cols, "count": len(boxes), "size": [boxes[0][2], boxes[0][3]]},
+            "model_version": model.model_version
+        }
+    
+    def _aggregate_tiles(self, labels: List[tuple], global_probs: Optional[np.ndarray], tile_probs: np.ndarray,
+                         rows: int, cols: int) -> Dict[str, Any]:
+        """
+        Crop comes from the averaged class probabilities. A disease confidently seen in any
+        tile wins over the averaged verdict, since a lesion may cover only one tile.
+        Confidence, the override threshold and the heatmap all use probabilities
+        renormalized over the diagnosed crop's classes. Tiles that barely show the crop
+        (background, soil, sky) can neither override nor light up the heatmap, since
+        renormalizing their tiny crop mass would blow noise up into confident disease.
+        """
+        mean_probs = tile_probs.mean(axis=0)
+        if global_probs is not None:
+            mean_probs = (global_probs + mean_probs) / 2
+        
+        crop_scores = {}
+        for idx, (crop_name, _) in enumerate(labels):
+            crop_scores[crop_name] = crop_scores.get(crop_name, 0.0) + float(mean_probs[idx])
+        crop_name = max(crop_scores, key=crop_scores.get)
+        
+        crop_classes = [idx for idx, (crop, _) in enumerate(labels) if crop == crop_name]
+        diseased = [idx for idx in crop_classes if "healthy" not in labels[idx][1].lower()]
+        
+        best_idx = max(crop_classes, key=lambda idx: mean_probs[idx])
+        confidence = float(mean_probs[best_idx]) / max(crop_scores[crop_name], 1e-12)
+        
+        # Per-tile probabilities given the diagnosed crop, zeroed where the crop is barely present
+        tile_crop_mass = tile_probs[:, crop_classes].sum(axis=1, keepdims=True)
+        tile_within = tile_probs / np.maximum(tile_crop_mass, 1e-12)
+        tile_within[tile_crop_mass[:, 0] < self.model_loader.settings.tile_min_crop_mass] = 0.0
+        if diseased:
+            tile_best = tile_within[:, diseased].max(axis=0)
+            if tile_best.max() >= self.model_loader.settings.tile_disease_threshold:
+                best_idx = diseased[int(np.argmax(tile_best))]
+                confidence = float(tile_best.max())
+        
+        # Probability that each tile shows any disease of the diagnosed crop
+        heatmap = tile_within[:, diseased].sum(axis=1) if diseased else np.zeros(len(tile_probs))
+        
+        return {
+            "crop": crop_name,
+            "disease": labels[best_idx][1],
+            "confidence": round(confidence, 4),
+            "heatmap": np.round(heatmap.reshape(rows, cols), 3).tolist(),
+        }
+    
+    def _analyze_sync(self, image_source: Union[str, Image.Image], image_sha256: Optional[str] = None) -> Dict[str, Any]:
+        # Load and process image
+        with stage("analyze_image.decode"):
+            if isinstance(image_source, Image.Image):
+                image = image_source.convert("RGB")
+            else:
+                image = Image.open(image_source).convert("RGB")
+        
+        # Get crop and disease prediction, pinning the classifier in case of a concurrent hot-swap
+        model = self.model_loader.crop_model
+        record_case = self.similarity_indexes is not None and image_sha256 is not None
+        with stage("analyze_image.classify"):
+            if record_case:
+                crop_name, disease_name, embedding = self.model_loader.predict_crop_and_disease(
+                    image, return_embedding=True, model=model
+                )
+            else:
+                crop_name, disease_name = self.model_loader.predict_crop_and_disease(image, model=model)
+        
+        # Generate captions
+        with stage("analyze_image.caption"):
+            blip_caption = self.model_loader.generate_blip_caption(image)
+        # vit_caption = self.model_loader.generate_vit_caption(image)
+        
+        # Merge captions intelligently
+        merged_caption = self._merge_captions(blip_caption, "")
+        
+        if record_case:
+            # Recording the case is best effort; it must never fail the diagnosis
+            with stage("analyze_image.index"):
+                try:
+                    self.similarity_indexes.for_version(model.model_version).add(embedding, {
+                        "image_sha256": image_sha256,
+                        "crop": crop_name,
+                        "disease": disease_name,
+                        "caption": merged_caption,
+                        "model_version": model.model_version
+                    })
+                except Exception as e:
+                    print(f"⚠️ Could not record similar case: {e}")
+        
+        return {
+            "caption": merged_caption,
+            "crop": crop_name,
+            "disease": disease_name,
+            "model_version": model.model_version
+        }
+    
+    def analyze_batch(self, batch: torch.Tensor, images: Optional[List[Image.Image]] = None) -> List[Dict[str, Any]]:
+        """
+        Classify a preprocessed batch in one forward pass, captioning the images if given
+        Blocking; meant for offline and batched callers
+        """
+        predictions = self.model_loader.predict_batch(batch)
+        captions = self.model_loader.generate_blip_captions(images) if images else [None] * len(predictions)
+        
+        return [
+            {
+                "caption": self._merge_captions(caption, "") if caption is not None else None,
                 "crop": crop_name,
-                "disease": disease_name
+                "disease": disease_name,
+                "confidence": round(confidence, 4)
             }
-            
-        except Exception as e:
-            raise Exception(f"Image analysis failed: {str(e)}")
+            for (crop_name, disease_name, confidence), caption in zip(predictions, captions)
+        ]
     
     def _merge_captions(self, blip_caption: str, vit_caption: str) -> str:
         """
@@ -0,0 +1,183 @@
+"""
+Opt-in per-request profiling with Chrome-trace output
+"""
+
+import asyncio
+import contextlib
+import hmac
+import json
+import os
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+from typing import Optional
+from urllib.parse import parse_qs
+
+import torch
+
+# Trace of the request being profiled in the current context, None when profiling is off
+_current_trace: ContextVar[Optional["RequestTrace"]] = ContextVar("request_trace", default=None)
+_null_stage = contextlib.nullcontext()
+
+# torch.profiler supports one session per process; further requests get stage timers only
+_torch_profiler_lock = threading.Lock()
+
+
+def stage(name: str):
+    """
+    Time a stage of the current request if it is being profiled.
+    Returns a shared no-op context otherwise, so unprofiled requests pay only a ContextVar lookup.
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return _null_stage
+    return trace.stage(name)
+
+
+def _all_threads_config():
+    """Profiler config that records ops from every thread; None on torch builds without the option"""
+    try:
+        return torch._C._profiler._ExperimentalConfig(profile_all_threads=True)
+    except (AttributeError, TypeError):
+        return None
+
+
+class RequestTrace:
+    def __init__(self, trace_id: str, path: str):
+        self.trace_id = trace_id
+        self.path = path
+        self.events = []
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.profiler = None
+
+    def start(self):
+        if _torch_profiler_lock.acquire(blocking=False):
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            # Inference runs in to_thread workers, not on the event loop thread that starts the profiler
+            self.profiler = torch.profiler.profile(activities=activities, experimental_config=_all_threads_config())
+            self.profiler.__enter__()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        start_ns = time.time_ns()
+        try:
+            if self.profiler is not None:
+                with torch.profiler.record_function(name):
+                    yield
+            else:
+                yield
+        finally:
+            self.events.append((name, start_ns, time.time_ns(), threading.get_ident()))
+
+    def stop(self):
+        """Stop the profiler on the thread that started it"""
+        self.end_ns = time.time_ns()
+        if self.profiler is not None:
+            try:
+                self.profiler.__exit__(None, None, None)
+            except Exception:
+                self.profiler = None
+                _torch_profiler_lock.release()
+                raise
+
+    def finish(self, trace_dir: str) -> str:
+        """Write the merged Chrome trace (may run in a worker thread); returns its path"""
+        end_ns = self.end_ns
+        os.makedirs(trace_dir, exist_ok=True)
+        trace_path = os.path.join(trace_dir, f"{self.trace_id}.json")
+
+        trace = {"traceEvents": []}
+        if self.profiler is not None:
+            try:
+                self.profiler.export_chrome_trace(trace_path)
+                with open(trace_path, "r") as f:
+                    trace = json.load(f)
+            finally:
+                _torch_profiler_lock.release()
+
+        # Kineto timestamps are relative to baseTimeNanoseconds when present
+        base_ns = trace.get("baseTimeNanoseconds", 0)
+        stage_events = [
+            {
+                "name": name,
+                "cat": "stage",
+                "ph": "X",
+                "pid": "request stages",
+                "tid": thread_id,
+                "ts": (start - base_ns) / 1000,
+                "dur": (end - start) / 1000,
+            }
+            for name, start, end, thread_id in self.events
+        ]
+        stage_events.append({
+            "name": f"request {self.path}",
+            "cat": "stage",
+            "ph": "X",
+            "pid": "request stages",
+            "tid": "request",
+            "ts": (self.start_ns - base_ns) / 1000,
+            "dur": (end_ns - self.start_ns) / 1000,
+        })
+        trace["traceEvents"] = trace.get("traceEvents", []) + stage_events
+        trace["requestProfile"] = {
+            "trace_id": self.trace_id,
+            "path": self.path,
+            "torch_profiler": self.profiler is not None,
+            "duration_ms": round((end_ns - self.start_ns) / 1e6, 3),
+        }
+
+        with open(trace_path, "w") as f:
+            json.dump(trace, f)
+        return trace_path
+
+
+class RequestProfilerMiddleware:
+    """
+    ASGI middleware that profiles a request when it carries `X-Profile: 1` (or `?profile=1`)
+    together with a valid `X-Admin-Token`. The trace id is returned in `X-Profile-Trace-Id`.
+    """
+
+    def __init__(self, app, admin_token: str, trace_dir: str):
+        self.app = app
+        self.admin_token = admin_token.encode() if admin_token else b""
+        self.trace_dir = trace_dir
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.admin_token or not self._requested(scope):
+            await self.app(scope, receive, send)
+            return
+
+        trace = RequestTrace(uuid.uuid4().hex, scope.get("path", ""))
+        trace_id_header = (b"x-profile-trace-id", trace.trace_id.encode())
+
+        async def send_with_trace_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [trace_id_header]
+            await send(message)
+
+        trace.start()
+        token = _current_trace.set(trace)
+        try:
+            await self.app(scope, receive, send_with_trace_id)
+        finally:
+            _current_trace.reset(token)
+            try:
+                trace.stop()
+                trace_path = await asyncio.to_thread(trace.finish, self.trace_dir)
+                print(f"🧭 Profile trace written to {trace_path}")
+            except Exception as e:
+                print(f"⚠️ Failed to write profile trace {trace.trace_id}: {e}")
+
+    def _requested(self, scope) -> bool:
+        headers = dict(scope.get("headers", []))
+        wants_profile = headers.get(b"x-profile") in (b"1", b"true")
+        if not wants_profile and b"profile=" in scope.get("query_string", b""):
+            query = parse_qs(scope["query_string"].decode("latin-1"))
+            wants_profile = query.get("profile", [""])[0] in ("1", "true")
+        if not wants_profile:
+            return False
+        return hmac.compare_digest(headers.get(b"x-admin-token", b""), self.admin_token)
@@ -0,0 +1,190 @@
+"""
+Diagnosis session state shared by a farmer's diagnose / ask / translate turns
+"""
+
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+SUPPORTED_LANGUAGES = ["en", "bn"]
+
+
+def build_context(result: Dict[str, Any]) -> str:
+    """Build the Q&A context from a diagnosis, in the same shape the frontend sends to /ask/"""
+    return "\n".join(
+        line for line in [
+            result.get("caption") and f"Caption: {result['caption']}",
+            result.get("crop") and f"Crop: {result['crop']}",
+            result.get("disease") and f"Disease: {result['disease']}",
+        ] if line
+    )
+
+
+class DiagnosisSession:
+    """
+    Server-side state for one session: the English diagnosis, its translations,
+    and the Q&A history with each turn's text cached per language.
+
+    History is compacted in blocks: once it holds more than max_turns turns the
+    oldest half is dropped at once, so the prompt prefix sent upstream stays
+    identical (and cacheable) for most turns instead of shifting every turn.
+    """
+
+    def __init__(self, openai_service, language: str = "en", session_id: Optional[str] = None,
+                 max_turns: int = 8, max_turn_chars: int = 600):
+        self.openai_service = openai_service
+        self.session_id = session_id or uuid.uuid4().hex
+        self.language = language
+        self.max_turns = max_turns
+        self.max_turn_chars = max_turn_chars
+        self.last_access = time.monotonic()
+
+        self.result_en: Optional[Dict[str, Any]] = None
+        self._context: Optional[str] = None
+        self._results: Dict[str, Dict[str, Any]] = {}
+        self.history: List[Dict[str, Any]] = []
+
+    @property
+    def result(self) -> Optional[Dict[str, Any]]:
+        """Diagnosis in the session's current language"""
+        return self._results.get(self.language, self.result_en)
+
+    async def set_diagnosis(self, result_en: Dict[str, Any]) -> Dict[str, Any]:
+        """Store a new English diagnosis (clearing the previous Q&A) and return it in the session language"""
+        self.result_en = result_en
+        self._context = build_context(result_en)
+        self._results = {"en": result_en}
+        self.history = []
+        await self._translate_result(self.language)
+        return self.result
+
+    async def ask(self, question: str, language: Optional[str] = None) -> Dict[str, Any]:
+        """Answer a follow-up question about the current diagnosis"""
+        language = language or self.language
+        prompt_history = [
+            (entry["prompt_question"], entry["answer"]["en"][:self.max_turn_chars]) for entry in self.history
+        ]
+        answer_en, answer = await self.openai_service.ask_in_session(
+            question, self._context, prompt_history, language, self.session_id
+        )
+
+        entry = {
+            "prompt_question": question[:self.max_turn_chars],
+            "question": {language: question},
+            "answer": {"en": answer_en, language: answer},
+            "timestamp": time.time(),
+        }
+        self.history.append(entry)
+        if len(self.history) > self.max_turns:
+            self.history = self.history[len(self.history) // 2:]
+        return self._entry_view(entry, language)
+
+    async def set_language(self, language: str):
+        """Switch language, translating the diagnosis and every Q&A turn concurrently"""
+        if language not in SUPPORTED_LANGUAGES:
+            raise ValueError(f"Supported languages: {', '.join(SUPPORTED_LANGUAGES)}")
+
+        tasks = [self._translate_result(language)]
+        for entry in self.history:
+            for field in ("question", "answer"):
+                if language not in entry[field]:
+                    tasks.append(self._translate_entry(entry, field, language))
+        await asyncio.gather(*tasks)
+        # Only switch once everything is translated, so a failure leaves the session unchanged
+        self.language = language
+
+    def get_history(self) -> List[Dict[str, Any]]:
+        """Q&A history in the current language"""
+        return [self._entry_view(entry, self.language) for entry in self.history]
+
+    async def _translate_result(self, language: str):
+        if self.result_en is None or language in self._results:
+            return
+        self._results[language] = await self.openai_service.translate_analysis_result(self.result_en, language)
+
+    async def _translate_entry(self, entry: Dict[str, Any], field: str, language: str):
+        # Translate from whichever language the text was first recorded in
+        source_text = next(iter(entry[field].values()))
+        entry[field][language] = await self.openai_service.translate_text(source_text, language)
+
+    @staticmethod
+    def _entry_view(entry: Dict[str, Any], language: str) -> Dict[str, Any]:
+        def pick(texts: Dict[str, str]) -> str:
+            return texts.get(language) or next(iter(texts.values()))
+
+        return {
+            "question": pick(entry["question"]),
+            "answer": pick(entry["answer"]),
+            "timestamp": entry["timestamp"],
+        }
+
+
+class SessionStore:
+    """In-memory diagnosis sessions with idle TTL and a cap on the number kept (LRU)"""
+
+    def __init__(self, settings, openai_service):
+        self.openai_service = openai_service
+        self.ttl = settings.session_ttl_seconds
+        self.max_sessions = settings.session_max_sessions
+        self.max_turns = settings.session_max_turns
+        self.max_turn_chars = settings.session_max_turn_chars
+        self._sessions: "OrderedDict[str, DiagnosisSession]" = OrderedDict()
+        self.evicted = 0
+
+    def create(self, language: str = "en") -> DiagnosisSession:
+        """Create and register a new session"""
+        session = self.build(language)
+        self.register(session)
+        return session
+
+    def build(self, language: str = "en") -> DiagnosisSession:
+        """Create a session without registering it (register once it holds a diagnosis)"""
+        return DiagnosisSession(
+            self.openai_service,
+            language if language in SUPPORTED_LANGUAGES else "en",
+            max_turns=self.max_turns,
+            max_turn_chars=self.max_turn_chars,
+        )
+
+    def register(self, session: DiagnosisSession):
+        """Make a session reachable by id, evicting expired and least recently used ones"""
+        self._evict_expired()
+        session.last_access = time.monotonic()
+        self._sessions[session.session_id] = session
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evicted += 1
+
+    def get(self, session_id: str) -> Optional[DiagnosisSession]:
+        """Return a live session and refresh its TTL, or None if unknown or expired"""
+        session = self._sessions.get(session_id)
+        if session is None:
+            return None
+        if time.monotonic() - session.last_access > self.ttl:
+            del self._sessions[session_id]
+            self.evicted += 1
+            return None
+        session.last_access = time.monotonic()
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def touch(self, session: DiagnosisSession):
+        """Keep a session held elsewhere (e.g. by an open WebSocket) registered and fresh"""
+        session.last_access = time.monotonic()
+        self._sessions[session.session_id] = session
+        self._sessions.move_to_end(session.session_id)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {"active": len(self._sessions), "evicted": self.evicted}
+
+    def _evict_expired(self):
+        # Sessions are kept in access order, so expired ones are at the front
+        now = time.monotonic()
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if now - session.last_access <= self.ttl:
+                break
+            del self._sessions[session_id]
+            self.evicted += 1
@@ -0,0 +1,404 @@
+"""
+Append-only embedding store for "similar past cases" lookup
+"""
+
+import array
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+# Rows scored per matrix multiply during exact search, bounds temporary memory
+SEARCH_CHUNK_ROWS = 131072
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cases (
+    case_id INTEGER PRIMARY KEY,
+    image_sha256 TEXT UNIQUE,
+    data TEXT NOT NULL
+);
+"""
+
+
+class SimilarityIndex:
+    """
+    Stores L2-normalized classifier embeddings in a memory-mapped float32 file
+    with case metadata in SQLite (row i describes vector i), and answers cosine
+    top-k queries. Only the k result rows are read back per query.
+
+    Small collections are searched exactly. Past `ann_threshold` vectors an IVF
+    index (k-means coarse quantizer, inverted lists) is trained and only the
+    `nprobe` closest lists are scanned.
+    """
+
+    def __init__(self, settings, dim: Optional[int] = None, index_dir: Optional[str] = None):
+        self.index_dir = index_dir or settings.similarity_index_dir
+        self.ann_threshold = settings.similarity_ann_threshold
+        self.nprobe = settings.similarity_nprobe
+        os.makedirs(self.index_dir, exist_ok=True)
+
+        self.vectors_path = os.path.join(self.index_dir, "vectors.f32")
+        self.db_path = os.path.join(self.index_dir, "cases.sqlite3")
+        self.legacy_metadata_path = os.path.join(self.index_dir, "cases.jsonl")
+        self.info_path = os.path.join(self.index_dir, "index.json")
+        self.ivf_path = os.path.join(self.index_dir, "ivf.npz")
+        # Serializes appends across worker processes sharing this directory
+        self.lock_path = os.path.join(self.index_dir, "append.lock")
+
+        self._lock = threading.Lock()
+        self.dim = dim
+        if os.path.exists(self.info_path):
+            with open(self.info_path, "r") as f:
+                self.dim = json.load(f)["dim"]
+
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._count = 0
+        self._mapping = (0, None)
+
+        # IVF state; vectors appended after training wait in per-list id arrays
+        self._centroids = None
+        self._list_offsets = None
+        self._list_members = None
+        self._pending_lists: List[array.array] = []
+        self._pending_count = 0
+        self._trained_count = 0
+        self._training = False
+
+        self._load()
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    def add(self, embedding: np.ndarray, case: Dict[str, Any]) -> Optional[int]:
+        """Append one embedding with its case metadata; returns the case id (None if already stored)"""
+        vector = self._normalize(np.asarray(embedding, dtype=np.float32).reshape(1, -1))
+
+        with self._lock, open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            image_sha256 = case.get("image_sha256")
+            if image_sha256 and self._conn.execute(
+                "SELECT 1 FROM cases WHERE image_sha256 = ?", (image_sha256,)
+            ).fetchone():
+                return None
+
+            if self.dim is None and os.path.exists(self.info_path):
+                with open(self.info_path, "r") as f:
+                    self.dim = json.load(f)["dim"]
+            if self.dim is None:
+                self.dim = vector.shape[1]
+                with open(self.info_path, "w") as f:
+                    json.dump({"dim": self.dim}, f)
+            elif vector.shape[1] != self.dim:
+                raise ValueError(f"Embedding has {vector.shape[1]} dims, index expects {self.dim}")
+
+            # The files are the source of truth: other processes may have appended since our last look
+            case_id = self._next_case_id()
+            record = {"case_id": case_id, "created_at": time.time(), **case}
+
+            # Vector first, then metadata; if the insert fails the vector is cut off again
+            with open(self.vectors_path, "ab") as f:
+                f.write(vector.tobytes())
+            try:
+                with self._conn:
+                    self._conn.execute(
+                        "INSERT INTO cases (case_id, image_sha256, data) VALUES (?, ?, ?)",
+                        (case_id, image_sha256 or None, json.dumps(record, ensure_ascii=False)),
+                    )
+            except Exception:
+                self._truncate_vectors(case_id)
+                raise
+            self._advance_count(case_id + 1)
+
+            # (Re)train in the background each time the collection doubles past the threshold
+            needs_training = (
+                not self._training
+                and self.count >= self.ann_threshold
+                and self.count >= 2 * max(self._trained_count, 1)
+            )
+            if needs_training:
+                self._training = True
+
+        if needs_training:
+            threading.Thread(target=self._train_in_background, daemon=True).start()
+        return case_id
+
+    def search(self, embedding: np.ndarray, k: int = 5, exclude_image: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Return the top-k most similar stored cases with cosine scores"""
+        with self._lock:
+            self._advance_count(self._stored_rows())
+        if self.count == 0:
+            return []
+
+        query = self._normalize(np.asarray(embedding, dtype=np.float32).reshape(1, -1))[0]
+        vectors = self._mapped()
+        # Ask for one extra in case the query image itself is stored
+        fetch = k + 1 if exclude_image else k
+
+        if self._centroids is not None:
+            ids, scores = self._search_ivf(vectors, query, fetch)
+        else:
+            ids, scores = self._search_exact(vectors, query, fetch)
+
+        cases = self._fetch_cases(ids)
+        results = []
+        for case_id, score in zip(ids.tolist(), scores):
+            case = cases.get(case_id)
+            if case is None:
+                continue  # Vector appended by another process whose metadata isn't committed yet
+            if exclude_image and case.get("image_sha256") == exclude_image:
+                continue
+            results.append({**case, "score": round(float(score), 4)})
+            if len(results) == k:
+                break
+        return results
+
+    def build_ann_index(self, num_lists: Optional[int] = None, iterations: int = 10, sample_size: int = 100000):
+        """Train the IVF coarse quantizer with k-means and assign every vector to a list"""
+        if self.count == 0:
+            return
+        vectors = self._mapped()
+        n = len(vectors)
+        num_lists = num_lists or max(1, int(np.sqrt(n)))
+        print(f"🧮 Building IVF index over {n} vectors with {num_lists} lists...")
+        start = time.perf_counter()
+
+        rng = np.random.default_rng(0)
+        sample = vectors[np.sort(rng.choice(n, size=min(n, sample_size), replace=False))]
+        centroids = sample[rng.choice(len(sample), size=min(num_lists, len(sample)), replace=False)].copy()
+
+        # Spherical k-means: vectors and centroids stay unit length, similarity is a dot product
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            empty = ~sums.any(axis=1)
+            sums[empty] = centroids[empty]
+            centroids = self._normalize(sums)
+
+        assignments = np.empty(n, dtype=np.int32)
+        for begin in range(0, n, SEARCH_CHUNK_ROWS):
+            chunk = vectors[begin:begin + SEARCH_CHUNK_ROWS]
+            assignments[begin:begin + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+
+        members = np.argsort(assignments, kind="stable").astype(np.int64)
+        offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=len(centroids)), out=offsets[1:])
+        # Other workers may train the same directory at once; replace the file whole
+        tmp_path = f"{self.ivf_path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, centroids=centroids, offsets=offsets, members=members, trained_count=n)
+        os.replace(tmp_path, self.ivf_path)
+
+        with self._lock:
+            self._centroids, self._list_offsets, self._list_members = centroids, offsets, members
+            # Vectors appended while we were training are reassigned against the new centroids
+            self._assign_pending(n, self.count)
+            self._trained_count = n
+        print(f"✅ IVF index built in {time.perf_counter() - start:.1f}s")
+
+    def _train_in_background(self):
+        try:
+            self.build_ann_index()
+        except Exception as e:
+            print(f"❌ IVF index build failed: {e}")
+        finally:
+            self._training = False
+
+    def _assign_pending(self, begin: int, end: int):
+        """Reset the pending lists and assign vectors [begin, end) appended after training to them"""
+        self._pending_lists = [array.array("q") for _ in range(len(self._centroids))]
+        self._pending_count = 0
+        self._extend_pending(begin, end)
+
+    def _extend_pending(self, begin: int, end: int):
+        """Add vectors [begin, end) to their nearest IVF lists"""
+        vectors = self._mapped()
+        for chunk_begin in range(begin, end, SEARCH_CHUNK_ROWS):
+            chunk = vectors[chunk_begin:min(end, chunk_begin + SEARCH_CHUNK_ROWS)]
+            for offset, list_id in enumerate(np.argmax(chunk @ self._centroids.T, axis=1).tolist()):
+                self._pending_lists[list_id].append(chunk_begin + offset)
+        self._pending_count += max(0, end - begin)
+
+    def _stored_rows(self) -> int:
+        if self.dim is None or not os.path.exists(self.vectors_path):
+            return 0
+        return os.path.getsize(self.vectors_path) // (self.dim * 4)
+
+    def _next_case_id(self) -> int:
+        """Row the next vector goes to; call with the append lock held"""
+        rows = self._stored_rows()
+        next_row = self._conn.execute("SELECT COALESCE(MAX(case_id) + 1, 0) FROM cases").fetchone()[0]
+        if rows > next_row:
+            # Vectors without metadata, left by a writer that died mid-append
+            self._truncate_vectors(next_row)
+            rows = next_row
+        elif rows < next_row:
+            raise RuntimeError(f"Similarity index is inconsistent: {rows} vectors for {next_row} cases")
+        return rows
+
+    def _truncate_vectors(self, rows: int):
+        with open(self.vectors_path, "ab") as f:
+            f.truncate(rows * self.dim * 4)
+        self._mapping = (0, None)
+
+    def _advance_count(self, count: int):
+        """Take in rows appended by this or another process; call with self._lock held"""
+        if count <= self._count:
+            return
+        begin, self._count = self._count, count
+        if self._centroids is not None:
+            self._extend_pending(begin, count)
+
+    def _fetch_cases(self, case_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+        if len(case_ids) == 0:
+            return {}
+        placeholders = ",".join("?" * len(case_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT case_id, data FROM cases WHERE case_id IN ({placeholders})", [int(i) for i in case_ids]
+            ).fetchall()
+        return {case_id: json.loads(data) for case_id, data in rows}
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "vectors": self.count,
+            "dim": self.dim,
+            "ann_index": self._centroids is not None,
+            "ann_lists": 0 if self._centroids is None else len(self._centroids),
+            "ann_unindexed": self._pending_count,
+        }
+
+    def _search_exact(self, vectors: np.ndarray, query: np.ndarray, k: int):
+        best_ids = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        for begin in range(0, len(vectors), SEARCH_CHUNK_ROWS):
+            scores = vectors[begin:begin + SEARCH_CHUNK_ROWS] @ query
+            ids = np.arange(begin, begin + len(scores))
+            best_ids, best_scores = self._merge_top_k(best_ids, best_scores, ids, scores, k)
+        return best_ids, best_scores
+
+    def _search_ivf(self, vectors: np.ndarray, query: np.ndarray, k: int):
+        with self._lock:
+            centroids, offsets, members = self._centroids, self._list_offsets, self._list_members
+            nprobe = min(self.nprobe, len(centroids))
+            probe_lists = np.argpartition(-(centroids @ query), nprobe - 1)[:nprobe]
+            # Copy the probed pending lists; add() may grow them once the lock is released
+            pending = [np.array(self._pending_lists[list_id], dtype=np.int64) for list_id in probe_lists]
+
+        candidates = [members[offsets[list_id]:offsets[list_id + 1]] for list_id in probe_lists]
+        candidates.extend(ids for ids in pending if len(ids))
+
+        ids = np.sort(np.concatenate(candidates)) if candidates else np.empty(0, dtype=np.int64)
+        ids = ids[ids < len(vectors)]
+        if len(ids) == 0:
+            return self._search_exact(vectors, query, k)
+        scores = vectors[ids] @ query
+        return self._merge_top_k(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32), ids, scores, k)
+
+    @staticmethod
+    def _merge_top_k(best_ids, best_scores, ids, scores, k):
+        ids = np.concatenate([best_ids, ids])
+        scores = np.concatenate([best_scores, scores])
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            ids, scores = ids[top], scores[top]
+        order = np.argsort(-scores)
+        return ids[order], scores[order]
+
+    def _mapped(self) -> np.ndarray:
+        """Memory-map the vector file, remapping only when new vectors were appended"""
+        count = self.count
+        mapped_count, vectors = self._mapping
+        if vectors is None or mapped_count != count:
+            vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(count, self.dim))
+            self._mapping = (count, vectors)
+        return vectors
+
+    def _load(self):
+        self._import_legacy_metadata()
+        if self.dim is None:
+            return
+
+        # Trim whichever store got ahead of the other
+        rows = self._conn.execute("SELECT COUNT(*) FROM cases").fetchone()[0]
+        row_bytes = self.dim * 4
+        vector_bytes = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+        count = min(vector_bytes // row_bytes, rows)
+        if vector_bytes != count * row_bytes:
+            with open(self.vectors_path, "ab") as f:
+                f.truncate(count * row_bytes)
+        if rows != count:
+            with self._conn:
+                self._conn.execute("DELETE FROM cases WHERE case_id >= ?", (count,))
+        self._count = count
+        if count == 0:
+            return
+
+        if os.path.exists(self.ivf_path):
+            ivf = np.load(self.ivf_path)
+            self._trained_count = min(int(ivf["trained_count"]), count)
+            self._centroids = ivf["centroids"]
+            self._list_offsets = ivf["offsets"]
+            self._list_members = ivf["members"]
+            self._assign_pending(self._trained_count, count)
+        print(f"🗂️ Similarity index loaded with {count} cases")
+
+    def _import_legacy_metadata(self):
+        """One-time move of metadata from the older cases.jsonl file into SQLite"""
+        if not os.path.exists(self.legacy_metadata_path):
+            return
+        if self._conn.execute("SELECT COUNT(*) FROM cases").fetchone()[0] == 0:
+            with open(self.legacy_metadata_path, "r", encoding="utf-8") as f, self._conn:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # Partial last line from an interrupted write
+                    self._conn.execute(
+                        "INSERT OR IGNORE INTO cases (case_id, image_sha256, data) VALUES (?, ?, ?)",
+                        (record["case_id"], record.get("image_sha256") or None, json.dumps(record, ensure_ascii=False)),
+                    )
+            print("🗂️ Moved similarity case metadata from cases.jsonl to SQLite")
+        os.replace(self.legacy_metadata_path, self.legacy_metadata_path + ".migrated")
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return (vectors / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+class SimilarityIndexes:
+    """
+    One SimilarityIndex per classifier version, each in its own subdirectory of
+    similarity_index_dir. Embeddings from different versions live in different
+    spaces (possibly of different sizes), so they are never searched together.
+    Indexes are opened on first use.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.root = settings.similarity_index_dir
+        self._indexes: Dict[str, SimilarityIndex] = {}
+        self._lock = threading.Lock()
+
+    def for_version(self, version: Optional[str]) -> SimilarityIndex:
+        name = os.path.basename(version or "") or "default"
+        with self._lock:
+            index = self._indexes.get(name)
+            if index is None:
+                index = SimilarityIndex(self.settings, index_dir=os.path.join(self.root, name))
+                self._indexes[name] = index
+        return index
+
+    def get_metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            indexes = dict(self._indexes)
+        return {name: index.get_metrics() for name, index in indexes.items()}
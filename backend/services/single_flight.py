@@ -0,0 +1,54 @@
+"""
+Single-flight coalescing for identical in-flight work
+"""
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+
+class SingleFlight:
+    """
+    Deduplicate concurrent calls that share a key.
+    The first caller starts the work; callers arriving while it is still
+    running await the same task instead of repeating it.
+    Keys are tuples whose first element names the kind of work (used for metrics).
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[Hashable, asyncio.Task] = {}
+        self._stats: Dict[str, Dict[str, int]] = {}
+
+    async def do(self, key: Tuple, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Run fn() once per key among concurrent callers and share its result"""
+        stats = self._stats.setdefault(key[0], {"executed": 0, "coalesced": 0, "errors": 0})
+
+        task = self._in_flight.get(key)
+        if task is None:
+            stats["executed"] += 1
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t: self._on_done(key, t, stats))
+        else:
+            stats["coalesced"] += 1
+
+        # Shield so one cancelled caller (e.g. a dropped client) doesn't cancel the shared work
+        return await asyncio.shield(task)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Return coalescing counts per kind of work"""
+        return {
+            "in_flight": len(self._in_flight),
+            "by_kind": {kind: dict(stats) for kind, stats in self._stats.items()},
+        }
+
+    def _on_done(self, key: Hashable, task: asyncio.Task, stats: Dict[str, int]):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        # Retrieve the exception so it isn't reported as unhandled when every caller has gone
+        if not task.cancelled() and task.exception() is not None:
+            stats["errors"] += 1
+
+
+def normalize_text(text: str) -> str:
+    """Collapse whitespace so trivially different inputs share a key"""
+    return " ".join(text.split()) if text else ""
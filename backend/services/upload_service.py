@@ -0,0 +1,380 @@
+"""
+Upload service for reading image uploads in bounded chunks
+"""
+
+import io
+import json
+import hashlib
+import struct
+import threading
+from contextlib import asynccontextmanager
+from typing import Optional, Tuple, Dict, Any
+from PIL import Image
+
+# Magic byte signatures for the formats we accept, mapped to file extensions
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"BM", "bmp"),
+    (b"II*\x00", "tiff"),
+    (b"MM\x00*", "tiff"),
+]
+
+FORMAT_EXTENSIONS = {
+    "jpeg": [".jpg", ".jpeg"],
+    "png": [".png"],
+    "bmp": [".bmp"],
+    "tiff": [".tiff", ".tif"],
+}
+
+# Allowance for multipart framing and small form fields on top of the file itself
+FORM_OVERHEAD_BYTES = 64 * 1024
+
+# How much of a request body is searched for the file part's first bytes
+SNIFF_WINDOW_BYTES = 64 * 1024
+
+
+class UploadRejectedError(Exception):
+    """Raised when an upload is rejected before or while it is read"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class BytesUpload:
+    """Adapter so payloads that arrive in memory (e.g. WebSocket frames) go through the same checks"""
+
+    def __init__(self, data: bytes, filename: Optional[str] = None):
+        self._stream = io.BytesIO(data)
+        self.filename = filename
+        self.size = len(data)
+
+    async def read(self, size: int = -1) -> bytes:
+        return self._stream.read(size)
+
+
+class UploadService:
+    def __init__(self, settings):
+        self.max_file_size = settings.max_file_size
+        self.max_video_size = settings.max_video_size
+        self.max_image_pixels = settings.max_image_pixels
+        self.chunk_size = settings.upload_chunk_size
+        self.allowed_extensions = [ext.lower() for ext in settings.allowed_image_extensions]
+
+        # Buffered-bytes accounting across all in-flight uploads
+        self._lock = threading.Lock()
+        self.in_flight_bytes = 0
+        self.peak_in_flight_bytes = 0
+        self.peak_upload_bytes = 0
+        self.accepted = 0
+        self.rejected = 0
+
+    @asynccontextmanager
+    async def read_image(self, file):
+        """
+        Read an UploadFile and open it as an image: `async with read_image(file) as (image, info)`.
+        Yields the opened (lazy) PIL image and a dict of upload info. The image decodes
+        from the upload buffer, so analyze it inside the block.
+        """
+        async with self.read_upload(file) as (buffer, info):
+            yield self.open_image(buffer), info
+
+    @asynccontextmanager
+    async def read_upload(self, file):
+        """
+        Read an UploadFile chunk by chunk, rejecting bad input as early as possible.
+        Yields the bounded buffer and a dict of upload info; the buffer counts
+        towards in_flight_bytes until the block exits.
+        """
+        # Reject on the declared size before reading anything
+        declared_size = getattr(file, "size", None)
+        if declared_size is not None and declared_size > self.max_file_size:
+            self._reject()
+            raise UploadRejectedError(413, f"File exceeds maximum size of {self.max_file_size} bytes")
+
+        buffer = bytearray()
+        digest = hashlib.sha256()
+        image_format = None
+        try:
+            try:
+                while True:
+                    chunk = await file.read(self.chunk_size)
+                    if not chunk:
+                        break
+
+                    if len(buffer) + len(chunk) > self.max_file_size:
+                        raise UploadRejectedError(413, f"File exceeds maximum size of {self.max_file_size} bytes")
+
+                    buffer.extend(chunk)
+                    digest.update(chunk)
+                    self._track(len(chunk))
+
+                    # Sniff format and dimensions from the first chunk
+                    if image_format is None:
+                        image_format = self._check_header(bytes(buffer), file.filename)
+
+                if image_format is None:
+                    raise UploadRejectedError(400, "Uploaded file is empty")
+
+            except UploadRejectedError:
+                self._reject()
+                raise
+
+            info = {
+                "format": image_format,
+                "bytes_read": len(buffer),
+                "sha256": digest.hexdigest(),
+            }
+            yield buffer, info
+
+        finally:
+            self._release(len(buffer))
+
+    def open_image(self, buffer) -> Image.Image:
+        """
+        Open a buffer read by read_upload (without copying it), checking its real dimensions
+        The upload only counts as accepted once this succeeds
+        """
+        try:
+            image = Image.open(BufferReader(buffer))
+            self._check_dimensions(*image.size)
+        except UploadRejectedError:
+            self._reject()
+            raise
+        except Image.DecompressionBombError as e:
+            self._reject()
+            raise UploadRejectedError(413, f"Image too large: {str(e)}")
+        except OSError as e:
+            self._reject()
+            raise UploadRejectedError(400, f"Could not decode image: {str(e)}")
+
+        with self._lock:
+            self.accepted += 1
+        return image
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Return upload buffering metrics"""
+        return {
+            "in_flight_bytes": self.in_flight_bytes,
+            "peak_in_flight_bytes": self.peak_in_flight_bytes,
+            "peak_upload_bytes": self.peak_upload_bytes,
+            "max_upload_bytes": self.max_file_size,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+        }
+
+    def _check_header(self, head: bytes, filename: Optional[str]) -> str:
+        """Validate magic bytes, extension and (when available) dimensions"""
+        image_format = self._sniff_format(head)
+        if image_format is None:
+            raise UploadRejectedError(415, "Unsupported or unrecognized image format")
+
+        allowed_for_format = [ext for ext in FORMAT_EXTENSIONS[image_format] if ext in self.allowed_extensions]
+        if not allowed_for_format:
+            raise UploadRejectedError(415, f"Image format '{image_format}' is not allowed")
+
+        if filename and "." in filename:
+            extension = "." + filename.rsplit(".", 1)[1].lower()
+            if extension not in self.allowed_extensions:
+                raise UploadRejectedError(415, f"File extension '{extension}' is not allowed")
+
+        dimensions = self._sniff_dimensions(head, image_format)
+        if dimensions is not None:
+            self._check_dimensions(*dimensions)
+
+        return image_format
+
+    def _check_dimensions(self, width: int, height: int):
+        if width <= 0 or height <= 0:
+            raise UploadRejectedError(400, "Image has invalid dimensions")
+        if width * height > self.max_image_pixels:
+            raise UploadRejectedError(413, f"Image dimensions {width}x{height} exceed {self.max_image_pixels} pixels")
+
+    @staticmethod
+    def _sniff_format(head: bytes) -> Optional[str]:
+        for signature, image_format in IMAGE_SIGNATURES:
+            if head.startswith(signature):
+                return image_format
+        return None
+
+    @staticmethod
+    def _sniff_dimensions(head: bytes, image_format: str) -> Optional[Tuple[int, int]]:
+        """Read width/height from the header bytes; None if not in this chunk"""
+        try:
+            if image_format == "png" and len(head) >= 24:
+                return struct.unpack(">II", head[16:24])
+
+            if image_format == "bmp" and len(head) >= 26:
+                width, height = struct.unpack("<ii", head[18:26])
+                return width, abs(height)
+
+            if image_format == "jpeg":
+                # Walk the marker segments until a start-of-frame marker
+                offset = 2
+                while offset + 9 <= len(head):
+                    if head[offset] != 0xFF:
+                        return None
+                    marker = head[offset + 1]
+                    if marker == 0xFF:
+                        offset += 1
+                        continue
+                    if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                        height, width = struct.unpack(">HH", head[offset + 5:offset + 9])
+                        return width, height
+                    segment_length = struct.unpack(">H", head[offset + 2:offset + 4])[0]
+                    offset += 2 + segment_length
+        except struct.error:
+            return None
+
+        # TIFF (or a header spanning chunks) is checked after the full read
+        return None
+
+    def _track(self, num_bytes: int):
+        with self._lock:
+            self.in_flight_bytes += num_bytes
+            self.peak_in_flight_bytes = max(self.peak_in_flight_bytes, self.in_flight_bytes)
+
+    def _release(self, num_bytes: int):
+        with self._lock:
+            self.in_flight_bytes -= num_bytes
+            self.peak_upload_bytes = max(self.peak_upload_bytes, num_bytes)
+
+    def _reject(self):
+        with self._lock:
+            self.rejected += 1
+
+
+class BufferReader(io.RawIOBase):
+    """Seekable read-only file over a bytes-like object; io.BytesIO would copy a bytearray"""
+
+    def __init__(self, buffer):
+        self._view = memoryview(buffer).cast("B")
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        end = len(self._view) if size is None or size < 0 else min(len(self._view), self._position + size)
+        data = self._view[self._position:end].tobytes()
+        self._position = max(self._position, end)
+        return data
+
+    def readinto(self, target) -> int:
+        data = self._view[self._position:self._position + len(target)]
+        target[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self) -> int:
+        return self._position
+
+
+class UploadLimitMiddleware:
+    """
+    ASGI middleware bounding upload request bodies before Starlette spools them to disk.
+    Rejects on Content-Length up front, counts bytes as the body arrives (for chunked
+    uploads) and on image routes checks the file part's magic bytes in the first chunks.
+    `routes` maps a path to "image" or "video"; other paths pass straight through.
+    """
+
+    def __init__(self, app, upload_service: UploadService, routes: Dict[str, str]):
+        self.app = app
+        self.upload_service = upload_service
+        self.routes = routes
+
+    async def __call__(self, scope, receive, send):
+        kind = self.routes.get(scope.get("path")) if scope["type"] == "http" else None
+        if kind is None:
+            await self.app(scope, receive, send)
+            return
+
+        max_size = self.upload_service.max_video_size if kind == "video" else self.upload_service.max_file_size
+        limit = max_size + FORM_OVERHEAD_BYTES
+        too_large = UploadRejectedError(413, f"File exceeds maximum size of {max_size} bytes")
+
+        content_length = dict(scope.get("headers", [])).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+            self.upload_service._reject()
+            await self._send_rejection(send, too_large)
+            return
+
+        state = {"received": 0, "head": b"", "sniffed": kind != "image", "error": None, "started": False}
+
+        async def limited_receive():
+            message = await receive()
+            if message["type"] == "http.request" and state["error"] is None:
+                body = message.get("body", b"")
+                state["received"] += len(body)
+                if state["received"] > limit:
+                    state["error"] = too_large
+                elif not state["sniffed"]:
+                    state["error"] = self._sniff(state, body)
+                if state["error"] is not None:
+                    raise state["error"]
+            return message
+
+        async def guarded_send(message):
+            # Once the body is rejected, whatever the app makes of the aborted read is replaced below
+            if state["error"] is not None:
+                return
+            if message["type"] == "http.response.start":
+                state["started"] = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except Exception:
+            if state["error"] is None:
+                raise
+
+        if state["error"] is not None and not state["started"]:
+            self.upload_service._reject()
+            await self._send_rejection(send, state["error"])
+
+    @staticmethod
+    def _sniff(state: Dict[str, Any], body: bytes) -> Optional[UploadRejectedError]:
+        """Find the file part in the first bytes of a multipart body and check its signature"""
+        head = state["head"] + body[:SNIFF_WINDOW_BYTES - len(state["head"])]
+        state["head"] = head
+        window_full = len(head) >= SNIFF_WINDOW_BYTES
+
+        part_start = head.find(b"filename=")
+        data_start = head.find(b"\r\n\r\n", part_start) if part_start >= 0 else -1
+        if data_start < 0 or len(head) < data_start + 4 + 16:
+            # Not enough of the file part yet; give up (leaving it to the endpoint) once the window is full
+            state["sniffed"] = window_full
+            return None
+
+        state["sniffed"] = True
+        state["head"] = b""
+        if UploadService._sniff_format(head[data_start + 4:]) is None:
+            return UploadRejectedError(415, "Unsupported or unrecognized image format")
+        return None
+
+    @staticmethod
+    async def _send_rejection(send, error: UploadRejectedError):
+        body = json.dumps({"detail": error.detail}).encode()
+        await send({
+            "type": "http.response.start",
+            "status": error.status_code,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"connection", b"close"),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,267 @@
+"""
+Video / burst-capture diagnosis: streamed frame decoding, sampling, deduplication and batched classification
+"""
+
+import asyncio
+import functools
+import threading
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+import torch
+
+from services.upload_service import UploadRejectedError
+from services.request_profiler import stage
+
+# Kept frames are converted straight to this size; BLIP works at 384px and the classifier at 224px
+FRAME_IMAGE_SIZE = 384
+
+# dHash only sees structure, so a mean colour shift larger than this (0-255 scale) also counts as a change
+COLOR_DELTA = 12
+
+
+def frame_signature(frame) -> tuple:
+    """
+    Cheap similarity signature of a decoded frame from a 9x8 downscale:
+    a 64-bit difference hash plus the mean RGB colour
+    """
+    pixels = frame.reformat(width=9, height=8, format="rgb24").to_ndarray().astype(np.float32)
+    gray = pixels.mean(axis=2)
+    bits = (gray[:, 1:] > gray[:, :-1]).flatten()
+    return int(np.packbits(bits).view(">u8")[0]), pixels.reshape(-1, 3).mean(axis=0)
+
+
+def is_near_duplicate(a: tuple, b: tuple, max_bits: int) -> bool:
+    return bin(a[0] ^ b[0]).count("1") <= max_bits and float(np.abs(a[1] - b[1]).max()) <= COLOR_DELTA
+
+
+class VideoService:
+    """
+    Decodes a video one frame at a time, samples frames at an interval that
+    adapts to the video's length, drops near-identical consecutive samples by
+    difference hash and classifies the rest in batches. Only the best frame of
+    the longest few segments is captioned. An image slot is held only around each
+    model call, not while frames are decoded.
+    """
+
+    def __init__(self, settings, model_loader, admission_controller):
+        self.model_loader = model_loader
+        self.admission_controller = admission_controller
+        self.max_video_size = settings.max_video_size
+        self.max_image_pixels = settings.max_image_pixels
+        self.sample_fps = settings.video_sample_fps
+        self.max_frames = settings.video_max_frames
+        self.hash_threshold = settings.video_hash_threshold
+        self.batch_size = settings.video_batch_size
+        self.caption_frames = settings.video_caption_frames
+
+        self._lock = threading.Lock()
+        self.videos = 0
+        self.decoded_frames = 0
+        self.analyzed_frames = 0
+        self.duplicates_dropped = 0
+        self.busy_seconds = 0.0
+
+    async def analyze_video(self, file, priority: str = "normal") -> Dict[str, Any]:
+        """
+        Analyze an uploaded video (an UploadFile, read from its spooled file)
+        Returns a per-segment timeline of crop/disease detections and throughput stats
+        """
+        declared_size = getattr(file, "size", None)
+        if declared_size is not None and declared_size > self.max_video_size:
+            raise UploadRejectedError(413, f"Video exceeds maximum size of {self.max_video_size} bytes")
+
+        try:
+            import av
+        except ImportError:
+            raise UploadRejectedError(503, "Video diagnosis requires PyAV: pip install av")
+
+        admit = functools.partial(
+            self.admission_controller.admit_blocking, "image", priority, asyncio.get_running_loop()
+        )
+        return await asyncio.to_thread(self._analyze_sync, av, file.file, admit)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        return {
+            "videos": self.videos,
+            "decoded_frames": self.decoded_frames,
+            "analyzed_frames": self.analyzed_frames,
+            "duplicates_dropped": self.duplicates_dropped,
+            "decode_fps": round(self.decoded_frames / self.busy_seconds, 1) if self.busy_seconds else None,
+        }
+
+    def _analyze_sync(self, av, stream_file, admit) -> Dict[str, Any]:
+        stream_file.seek(0, 2)
+        if stream_file.tell() > self.max_video_size:
+            raise UploadRejectedError(413, f"Video exceeds maximum size of {self.max_video_size} bytes")
+        stream_file.seek(0)
+
+        # Pin the classifier so a concurrent hot-swap can't change it mid-video
+        model = self.model_loader.crop_model
+        start = time.perf_counter()
+        try:
+            container = av.open(stream_file, mode="r")
+        except (av.error.FFmpegError, ValueError) as e:
+            raise UploadRejectedError(400, f"Could not decode video: {str(e)}")
+
+        with container:
+            if not container.streams.video:
+                raise UploadRejectedError(400, "Upload has no video stream")
+            stream = container.streams.video[0]
+            stream.thread_type = "AUTO"
+            width, height = stream.codec_context.width, stream.codec_context.height
+            if width * height > self.max_image_pixels:
+                raise UploadRejectedError(413, f"Video frames {width}x{height} exceed {self.max_image_pixels} pixels")
+            scale = min(1.0, FRAME_IMAGE_SIZE / max(width, height, 1))
+            image_size = {"width": max(1, round(width * scale)), "height": max(1, round(height * scale))}
+
+            duration = float(stream.duration * stream.time_base) if stream.duration and stream.time_base else None
+            if duration is None and container.duration:
+                duration = container.duration / av.time_base
+
+            # Spread the frame budget over long videos instead of only covering their start
+            interval = 1.0 / self.sample_fps
+            if duration:
+                interval = max(interval, duration / self.max_frames)
+
+            detections = []
+            pending = []
+            decoded = sampled = dropped = 0
+            next_sample = 0.0
+            last_timestamp = 0.0
+            last_signature = None
+            truncated = False
+            frame_rate = float(stream.average_rate) if stream.average_rate else 25.0
+
+            with stage("analyze_video.decode_and_classify"):
+                try:
+                    for frame in container.decode(stream):
+                        decoded += 1
+                        timestamp = float(frame.time) if frame.time is not None else (decoded - 1) / frame_rate
+                        if timestamp < next_sample:
+                            continue
+                        next_sample = timestamp + interval
+                        last_timestamp = timestamp
+                        sampled += 1
+
+                        # Cheap dedup before paying for RGB conversion and inference
+                        signature = frame_signature(frame)
+                        if last_signature is not None and is_near_duplicate(signature, last_signature, self.hash_threshold):
+                            dropped += 1
+                            continue
+                        last_signature = signature
+
+                        pending.append((timestamp, frame.to_image(**image_size)))
+                        if len(pending) == self.batch_size:
+                            with admit():
+                                detections.extend(self._classify(pending, model))
+                            pending = []
+
+                        if len(detections) + len(pending) >= self.max_frames:
+                            truncated = True
+                            break
+                except av.error.FFmpegError as e:
+                    if decoded == 0:
+                        raise UploadRejectedError(400, f"Could not decode video: {str(e)}")
+                    # Keep what was decoded before a corrupt tail
+                    truncated = True
+
+                if pending:
+                    with admit():
+                        detections.extend(self._classify(pending, model))
+
+        if not detections:
+            raise UploadRejectedError(400, "No frames could be decoded from the video")
+
+        # The timeline runs to the end of the video unless analysis stopped early
+        end_time = duration if duration and not truncated else last_timestamp + interval
+        segments = self._build_segments(detections, end_time)
+        with stage("analyze_video.caption"), admit():
+            self._caption_segments(segments)
+
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.videos += 1
+            self.decoded_frames += decoded
+            self.analyzed_frames += len(detections)
+            self.duplicates_dropped += dropped
+            self.busy_seconds += elapsed
+
+        # Dominant diagnosis: the label seen in the most analyzed frames
+        frame_counts = {}
+        for segment in segments:
+            label = (segment["crop"], segment["disease"])
+            frame_counts[label] = frame_counts.get(label, 0) + segment["frames"]
+        crop_name, disease_name = max(frame_counts, key=frame_counts.get)
+
+        return {
+            "crop": crop_name,
+            "disease": disease_name,
+            "segments": [{key: value for key, value in segment.items() if key != "image"} for segment in segments],
+            "stats": {
+                "duration": round(duration, 3) if duration else None,
+                "decoded_frames": decoded,
+                "sampled_frames": sampled,
+                "duplicates_dropped": dropped,
+                "analyzed_frames": len(detections),
+                "truncated": truncated,
+                "elapsed_seconds": round(elapsed, 3),
+                "decode_fps": round(decoded / elapsed, 1),
+                "analyzed_fps": round(len(detections) / elapsed, 1),
+            },
+            "model_version": getattr(model, "model_version", None),
+        }
+
+    def _classify(self, frames: List[tuple], model) -> List[Dict[str, Any]]:
+        """Classify (timestamp, image) pairs in one forward pass"""
+        batch = torch.stack([self.model_loader.transform(image) for _, image in frames])
+        predictions = self.model_loader.predict_batch(batch, model=model)
+        return [
+            {"time": timestamp, "crop": crop_name, "disease": disease_name, "confidence": confidence, "image": image}
+            for (timestamp, image), (crop_name, disease_name, confidence) in zip(frames, predictions)
+        ]
+
+    @staticmethod
+    def _build_segments(detections: List[Dict[str, Any]], end_time: float) -> List[Dict[str, Any]]:
+        """
+        Merge consecutive frames with the same label into timeline segments
+        Segments are contiguous: each runs until the next one starts, since dropped duplicates carry the previous label
+        """
+        segments = []
+        for detection in detections:
+            segment = segments[-1] if segments else None
+            if segment and (segment["crop"], segment["disease"]) == (detection["crop"], detection["disease"]):
+                segment["frames"] += 1
+                segment["confidence_sum"] += detection["confidence"]
+                if detection["confidence"] > segment["best_confidence"]:
+                    segment["best_confidence"], segment["image"] = detection["confidence"], detection["image"]
+                continue
+            if segment:
+                segment["end"] = round(detection["time"], 3)
+            segments.append({
+                "start": round(detection["time"], 3),
+                "end": None,
+                "crop": detection["crop"],
+                "disease": detection["disease"],
+                "frames": 1,
+                "confidence_sum": detection["confidence"],
+                "best_confidence": detection["confidence"],
+                "image": detection["image"],
+                "caption": None,
+            })
+
+        segments[-1]["end"] = round(max(end_time, segments[-1]["start"]), 3)
+        for segment in segments:
+            segment["confidence"] = round(segment.pop("confidence_sum") / segment["frames"], 4)
+            segment.pop("best_confidence")
+        return segments
+
+    def _caption_segments(self, segments: List[Dict[str, Any]]):
+        """Caption the most confident frame of the longest few segments in one batched call"""
+        if self.caption_frames <= 0:
+            return
+        chosen = sorted(segments, key=lambda segment: segment["frames"], reverse=True)[:self.caption_frames]
+        captions = self.model_loader.generate_blip_captions([segment["image"] for segment in chosen])
+        for segment, caption in zip(chosen, captions):
+            segment["caption"] = caption.strip()
@@ -0,0 +1,58 @@
+"""
+Tests for how per-tile predictions are combined into one diagnosis
+Run from backend/: python -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+try:
+    from services.prediction_service import PredictionService
+except ImportError:  # torch / transformers not installed
+    PredictionService = None
+
+LABELS = [("Tomato", "Healthy"), ("Tomato", "Late Blight"), ("Background", "Soil")]
+
+
+@unittest.skipIf(PredictionService is None, "torch and transformers are required")
+class AggregateTilesTest(unittest.TestCase):
+    def setUp(self):
+        settings = SimpleNamespace(tile_disease_threshold=0.6, tile_min_crop_mass=0.5)
+        self.service = PredictionService(SimpleNamespace(settings=settings))
+
+    def aggregate(self, tile_probs):
+        return self.service._aggregate_tiles(LABELS, None, np.array(tile_probs), 2, 2)
+
+    def test_background_tile_noise_does_not_override(self):
+        # The last tile is almost all background: 0.4% Healthy and 1.6% Blight would be
+        # 80% Blight once renormalized over the crop
+        result = self.aggregate([
+            [0.95, 0.03, 0.02],
+            [0.96, 0.02, 0.02],
+            [0.94, 0.04, 0.02],
+            [0.004, 0.016, 0.98],
+        ])
+        self.assertEqual(result["crop"], "Tomato")
+        self.assertEqual(result["disease"], "Healthy")
+        self.assertEqual(result["heatmap"][1][1], 0.0)
+
+    def test_lesion_in_one_crop_tile_overrides(self):
+        result = self.aggregate([
+            [0.95, 0.03, 0.02],
+            [0.96, 0.02, 0.02],
+            [0.94, 0.04, 0.02],
+            [0.2, 0.75, 0.05],
+        ])
+        self.assertEqual(result["disease"], "Late Blight")
+        self.assertAlmostEqual(result["confidence"], 0.75 / 0.95, places=4)
+        self.assertAlmostEqual(result["heatmap"][1][1], round(0.75 / 0.95, 3))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,158 @@
+"""
+Tests for upload validation: magic-byte and dimension sniffing, and the upload limit middleware
+Run from backend/: python -m unittest discover tests
+"""
+
+import asyncio
+import io
+import os
+import struct
+import sys
+import unittest
+from types import SimpleNamespace
+
+from fastapi import FastAPI, File, UploadFile
+from fastapi.testclient import TestClient
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from services.upload_service import (
+    BytesUpload,
+    UploadLimitMiddleware,
+    UploadRejectedError,
+    UploadService,
+)
+
+
+def make_settings(**overrides):
+    settings = {
+        "max_file_size": 1024 * 1024,
+        "max_video_size": 4 * 1024 * 1024,
+        "max_image_pixels": 4000 * 4000,
+        "upload_chunk_size": 64 * 1024,
+        "allowed_image_extensions": [".jpg", ".jpeg", ".png", ".bmp"],
+    }
+    settings.update(overrides)
+    return SimpleNamespace(**settings)
+
+
+def encode_image(image_format: str, size=(40, 30)) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", size, (30, 120, 40)).save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+class SniffFormatTest(unittest.TestCase):
+    def test_known_signatures(self):
+        self.assertEqual(UploadService._sniff_format(encode_image("JPEG")), "jpeg")
+        self.assertEqual(UploadService._sniff_format(encode_image("PNG")), "png")
+        self.assertEqual(UploadService._sniff_format(encode_image("BMP")), "bmp")
+        self.assertEqual(UploadService._sniff_format(b"II*\x00rest"), "tiff")
+        self.assertEqual(UploadService._sniff_format(b"MM\x00*rest"), "tiff")
+
+    def test_unknown_signatures(self):
+        self.assertIsNone(UploadService._sniff_format(b"GIF89a..."))
+        self.assertIsNone(UploadService._sniff_format(b"<html>"))
+        self.assertIsNone(UploadService._sniff_format(b""))
+
+
+class SniffDimensionsTest(unittest.TestCase):
+    def test_png(self):
+        self.assertEqual(UploadService._sniff_dimensions(encode_image("PNG"), "png"), (40, 30))
+
+    def test_jpeg_skips_segments_before_start_of_frame(self):
+        self.assertEqual(UploadService._sniff_dimensions(encode_image("JPEG", (123, 45)), "jpeg"), (123, 45))
+
+    def test_bmp_in_either_row_order(self):
+        head = encode_image("BMP")
+        self.assertEqual(UploadService._sniff_dimensions(head, "bmp"), (40, 30))
+        # Negative height marks a top-down bitmap
+        top_down = head[:22] + struct.pack("<i", -30) + head[26:]
+        self.assertEqual(UploadService._sniff_dimensions(top_down, "bmp"), (40, 30))
+
+    def test_truncated_headers(self):
+        self.assertIsNone(UploadService._sniff_dimensions(encode_image("PNG")[:20], "png"))
+        self.assertIsNone(UploadService._sniff_dimensions(encode_image("JPEG")[:10], "jpeg"))
+        self.assertIsNone(UploadService._sniff_dimensions(b"II*\x00", "tiff"))
+
+
+class ReadImageTest(unittest.TestCase):
+    def read(self, service, data, filename="leaf.png"):
+        async def run():
+            async with service.read_image(BytesUpload(data, filename)) as (image, info):
+                return image.size, info
+
+        return asyncio.run(run())
+
+    def test_accepts_valid_image(self):
+        service = UploadService(make_settings())
+        size, info = self.read(service, encode_image("PNG"))
+        self.assertEqual(size, (40, 30))
+        self.assertEqual(info["format"], "png")
+        self.assertEqual(service.get_metrics()["accepted"], 1)
+        self.assertEqual(service.in_flight_bytes, 0)
+
+    def test_rejects_oversized_dimensions_from_header(self):
+        service = UploadService(make_settings(max_image_pixels=100))
+        with self.assertRaises(UploadRejectedError) as caught:
+            self.read(service, encode_image("PNG"))
+        self.assertEqual(caught.exception.status_code, 413)
+
+    def test_rejects_disallowed_extension(self):
+        service = UploadService(make_settings())
+        with self.assertRaises(UploadRejectedError) as caught:
+            self.read(service, encode_image("PNG"), filename="leaf.exe")
+        self.assertEqual(caught.exception.status_code, 415)
+
+    def test_undecodable_image_is_not_counted_as_accepted(self):
+        service = UploadService(make_settings())
+        with self.assertRaises(UploadRejectedError) as caught:
+            self.read(service, encode_image("JPEG")[:200], filename="leaf.jpg")
+        self.assertEqual(caught.exception.status_code, 400)
+        metrics = service.get_metrics()
+        self.assertEqual((metrics["accepted"], metrics["rejected"]), (0, 1))
+
+
+class UploadLimitMiddlewareTest(unittest.TestCase):
+    def setUp(self):
+        self.service = UploadService(make_settings(max_file_size=32 * 1024))
+        app = FastAPI()
+        app.add_middleware(UploadLimitMiddleware, upload_service=self.service, routes={"/upload": "image"})
+
+        @app.post("/upload")
+        async def upload(file: UploadFile = File(...)):
+            async with self.service.read_image(file) as (image, info):
+                return {"format": info["format"], "size": list(image.size)}
+
+        @app.post("/other")
+        async def other(file: UploadFile = File(...)):
+            return {"bytes": len(await file.read())}
+
+        self.client = TestClient(app)
+
+    def post(self, path, data, filename="leaf.png"):
+        return self.client.post(path, files={"file": (filename, data, "image/png")})
+
+    def test_valid_upload_passes(self):
+        response = self.post("/upload", encode_image("PNG"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"format": "png", "size": [40, 30]})
+
+    def test_rejects_on_content_length(self):
+        response = self.post("/upload", b"\x89PNG\r\n\x1a\n" + b"\x00" * (200 * 1024))
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(self.service.get_metrics()["rejected"], 1)
+
+    def test_rejects_bad_magic_bytes(self):
+        response = self.post("/upload", b"<html>" + b"\x00" * 1024)
+        self.assertEqual(response.status_code, 415)
+
+    def test_other_routes_pass_through(self):
+        response = self.post("/other", b"\x00" * (200 * 1024))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"bytes": 200 * 1024})
+
+
+if __name__ == "__main__":
+    unittest.main()
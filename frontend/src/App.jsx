@@ -7,12 +7,14 @@ import ModelResult from "./component/ModelResult.jsx";
 import History from "./component/History.jsx";
 import ErrorBoundary from "./component/ErrorBoundary.jsx";
 import { getTranslation } from "./utils/translations.js";
+import { SessionSocket } from "./utils/sessionSocket.js";
 
 // API base (allow override by environment variable VITE_API_BASE_URL)
 const API_BASE = import.meta.env.VITE_API_BASE_URL || "http://localhost:8000";
 
 function App() {
   const [result, setResult] = useState(null);
+  const [sessionId, setSessionId] = useState(null);
   const [history, setHistory] = useState([]);
   const [loading, setLoading] = useState(false);
   const [asking, setAsking] = useState(false);
@@ -23,6 +25,7 @@ function App() {
   const [showToast, setShowToast] = useState(false);
   const historyRef = useRef(null);
   const endOfMessagesRef = useRef(null);
+  const socketRef = useRef(null);
 
   // Toast notification function
   const showToastNotification = (message, type = "success") => {
@@ -32,15 +35,57 @@ function App() {
     setTimeout(() => setShowToast(false), 3000);
   };
 
+  const closeSessionSocket = () => {
+    socketRef.current?.close();
+    socketRef.current = null;
+  };
+
+  // Open a fresh session socket for a new diagnosis; null means use HTTP instead
+  const openSessionSocket = async () => {
+    closeSessionSocket();
+    try {
+      socketRef.current = await new SessionSocket(API_BASE, currentLanguage).ready;
+      return socketRef.current;
+    } catch (err) {
+      console.warn("Session socket unavailable, using HTTP:", err);
+      return null;
+    }
+  };
+
+  // The socket is only used while it holds the session behind the current result
+  const activeSocket = () => {
+    const socket = socketRef.current;
+    return socket?.isOpen && socket.sessionId && socket.sessionId === sessionId
+      ? socket
+      : null;
+  };
+
+  // Server replies on the socket carry a status; only a broken connection falls back to HTTP
+  const isSocketFailure = (err) => err.status === undefined;
+
   const uploadImage = async (imageFile) => {
     const formData = new FormData();
     formData.append("file", imageFile);
     formData.append("language", currentLanguage);
     setLoading(true);
     setResult(null); // Clear previous results
+    setSessionId(null);
     setHistory([]); // Clear previous Q&A when new image is uploaded
 
     try {
+      const socket = await openSessionSocket();
+      if (socket) {
+        try {
+          const diagnosis = await socket.diagnose(imageFile);
+          setResult(diagnosis);
+          setSessionId(socket.sessionId);
+          return;
+        } catch (err) {
+          if (!isSocketFailure(err)) throw err;
+          console.warn("Session socket failed, retrying over HTTP:", err);
+        }
+      }
+
       // Try richer diagnose endpoint first
       let res;
       try {
@@ -54,6 +99,7 @@ function App() {
         });
       }
       setResult(res.data);
+      setSessionId(res.data.session_id || null);
     } catch (err) {
       console.error(err);
       alert("Image processing failed. Check backend logs.");
@@ -66,27 +112,57 @@ function App() {
     console.log("Asking question:", question);
     if (!question || !result) return;
 
-    const formData = new FormData();
-    formData.append("question", question);
-    formData.append("language", currentLanguage);
-    const context = [
-      result?.caption && `Caption: ${result.caption}`,
-      result?.crop && `Crop: ${result.crop}`,
-      result?.disease && `Disease: ${result.disease}`,
-    ]
-      .filter(Boolean)
-      .join("\n");
-    if (context) formData.append("context", context);
+    // With a server-side session the backend already holds the diagnosis
+    const buildFormData = (useSession) => {
+      const formData = new FormData();
+      formData.append("question", question);
+      formData.append("language", currentLanguage);
+      if (useSession) {
+        formData.append("session_id", sessionId);
+        return formData;
+      }
+      const context = [
+        result?.caption && `Caption: ${result.caption}`,
+        result?.crop && `Crop: ${result.crop}`,
+        result?.disease && `Disease: ${result.disease}`,
+      ]
+        .filter(Boolean)
+        .join("\n");
+      if (context) formData.append("context", context);
+      return formData;
+    };
 
     setAsking(true);
     try {
       console.log("Sending request to backend...");
-      const res = await axios.post(`${API_BASE}/ask/`, formData);
-      console.log("Received response:", res.data);
+      let answer = null;
+      const socket = activeSocket();
+      if (socket) {
+        try {
+          answer = (await socket.ask(question)).answer;
+        } catch (err) {
+          if (!isSocketFailure(err)) throw err;
+          console.warn("Session socket failed, retrying over HTTP:", err);
+        }
+      }
+
+      if (answer === null) {
+        let res;
+        try {
+          res = await axios.post(`${API_BASE}/ask/`, buildFormData(Boolean(sessionId)));
+        } catch (err) {
+          // Session expired on the server: fall back to sending the context
+          if (!sessionId || err.response?.status !== 404) throw err;
+          setSessionId(null);
+          res = await axios.post(`${API_BASE}/ask/`, buildFormData(false));
+        }
+        answer = res.data.answer;
+      }
+      console.log("Received answer:", answer);
 
       const newEntry = {
         question: question,
-        answer: res.data.answer,
+        answer: answer,
         timestamp: Date.now(),
       };
       console.log("Adding to history:", newEntry);
@@ -128,12 +204,31 @@ function App() {
     console.log("Original result:", originalResult);
     console.log("Original history length:", originalHistory.length);
 
+    // Set once the server-side session has switched language
+    let socketState = null;
+    const socket = activeSocket();
+
     try {
+      // Step 0: Over the session socket the server translates its own copy of the
+      // result and of the recent Q&A turns it keeps; older turns still use /translate/
+      if (socket) {
+        try {
+          socketState = await socket.setLanguage(newLanguage);
+        } catch (err) {
+          if (!isSocketFailure(err)) throw err;
+          console.warn("Session socket failed, translating over HTTP:", err);
+        }
+      }
+      const socketTurns = socketState
+        ? Math.min(socketState.history.length, history.length)
+        : 0;
+      const firstSocketTurn = history.length - socketTurns;
+
       // Step 1: Prepare all translation requests
       const translationTasks = [];
 
       // Add result translation if exists
-      if (result) {
+      if (result && !socketState) {
         const formData = new FormData();
         formData.append("caption", result.caption);
         formData.append("crop", result.crop);
@@ -154,6 +249,7 @@ function App() {
           history.length
         );
         history.forEach((item, index) => {
+          if (index >= firstSocketTurn) return;
           const questionText = item.question || item.q || "";
           const answerText = item.answer || item.a || "";
 
@@ -236,6 +332,20 @@ function App() {
         }
       });
 
+      if (socketState) {
+        if (result) newResult = { ...originalResult, ...socketState.result };
+        socketState.history
+          .slice(socketState.history.length - socketTurns)
+          .forEach((turn, i) => {
+            const index = firstSocketTurn + i;
+            newHistory[index] = {
+              ...originalHistory[index],
+              question: turn.question,
+              answer: turn.answer,
+            };
+          });
+      }
+
       // Step 5: Apply all changes atomically
       setCurrentLanguage(newLanguage);
       if (result) setResult(newResult);
@@ -252,8 +362,13 @@ function App() {
         status: err.response?.status,
       });
 
-      // Rollback: Restore original state
+      // Rollback: Restore original state (on the server too; its translations are cached)
       console.log("Rolling back to original state...");
+      if (socketState) {
+        socket.setLanguage(originalLanguage).catch((rollbackErr) =>
+          console.error("Session language rollback failed:", rollbackErr)
+        );
+      }
       setCurrentLanguage(originalLanguage);
       setResult(originalResult);
       setHistory(originalHistory);
@@ -269,10 +384,15 @@ function App() {
   };
 
   const resetForNewImage = () => {
+    closeSessionSocket();
     setResult(null);
+    setSessionId(null);
     setHistory([]);
   };
 
+  // Close the session socket when the app unmounts
+  useEffect(() => () => socketRef.current?.close(), []);
+
   useEffect(() => {
     endOfMessagesRef.current?.scrollIntoView({ behavior: "smooth" });
   }, [history, result]);
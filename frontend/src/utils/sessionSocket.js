@@ -0,0 +1,75 @@
+// Client for the backend's /ws/session socket: one connection per diagnosis, so
+// follow-up questions and language switches don't resend the image or context.
+// The server answers messages in the order they arrive, so replies are matched
+// to requests first-in first-out (binary image frames can't carry an id).
+
+export class SessionSocket {
+  constructor(apiBase, language) {
+    const url = `${apiBase.replace(/^http/, "ws")}/ws/session?language=${encodeURIComponent(language)}`;
+    this.sessionId = null;
+    this.pending = [];
+    this.socket = new WebSocket(url);
+
+    // Resolves with the socket once connected; rejects if it can't connect
+    this.ready = new Promise((resolve, reject) => {
+      this.socket.onopen = () => resolve(this);
+      this.socket.onerror = () => reject(new Error("Session socket could not connect"));
+    });
+    this.socket.onmessage = (event) => this.handleReply(JSON.parse(event.data));
+    this.socket.onclose = () => this.failPending(new Error("Session socket closed"));
+  }
+
+  get isOpen() {
+    return this.socket.readyState === WebSocket.OPEN;
+  }
+
+  // Diagnose an image File; resolves with the diagnosis in the session language
+  async diagnose(file) {
+    const reply = await this.request(await file.arrayBuffer());
+    this.sessionId = reply.session_id;
+    return reply.result;
+  }
+
+  // Resolves with { question, answer, timestamp }
+  ask(question) {
+    return this.request(JSON.stringify({ type: "ask", question }));
+  }
+
+  // Resolves with { language, result, history } translated on the server
+  setLanguage(language) {
+    return this.request(JSON.stringify({ type: "language", language }));
+  }
+
+  close() {
+    this.socket.close();
+  }
+
+  request(payload) {
+    if (!this.isOpen) {
+      return Promise.reject(new Error("Session socket is not open"));
+    }
+    return new Promise((resolve, reject) => {
+      this.pending.push({ resolve, reject });
+      this.socket.send(payload);
+    });
+  }
+
+  // Server errors carry the HTTP-style status; connection failures have none
+  handleReply(reply) {
+    const waiter = this.pending.shift();
+    if (!waiter) return;
+    if (reply.type === "error") {
+      const error = new Error(reply.detail || "Session request failed");
+      error.status = reply.status;
+      waiter.reject(error);
+    } else {
+      waiter.resolve(reply);
+    }
+  }
+
+  failPending(error) {
+    const pending = this.pending;
+    this.pending = [];
+    pending.forEach((waiter) => waiter.reject(error));
+  }
+}